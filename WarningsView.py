@@ -0,0 +1,70 @@
+import discord
+
+EMBED_LIMIT = 4096
+
+class WarningsView(discord.ui.View):
+    """
+    Pages through rows from `fetch_page(cursor, limit)` one page at a time,
+    keyset style: the cursor for the next page is taken from the last row
+    shown, and the cursors for the pages already seen are kept so Prev
+    doesn't have to count back from the start
+    """
+    def __init__(self, embed, header, fetch_page, render, cursor_for, page_size=10, timeout=600):
+        super().__init__(timeout=timeout)
+        self.embed = embed
+        self.header = header
+        self.fetch_page = fetch_page
+        self.render = render
+        self.cursor_for = cursor_for
+        self.page_size = page_size
+        self.cursors = [None]
+        self.next_cursor = None
+        self.message = None
+
+    async def on_timeout(self):
+        for child in self.children:
+            child.disabled = True
+        if self.message:
+            try: await self.message.edit(view=self)
+            except discord.HTTPException: pass
+
+    async def load(self):
+        """Render the page starting at the current cursor into self.embed, False on a db error"""
+        rows = await self.fetch_page(self.cursors[-1], self.page_size + 1)
+        if rows == False:
+            return False
+
+        description = f'{self.header} - page {len(self.cursors)}\n'
+        shown = 0
+        for row in rows[:self.page_size]:
+            entry = self.render(row)
+            if len(description) + len(entry) > EMBED_LIMIT:
+                if shown > 0:
+                    break
+                entry = entry[:EMBED_LIMIT - len(description)]
+            description += entry
+            shown += 1
+
+        self.embed.description = description
+        self.next_cursor = self.cursor_for(rows[shown - 1]) if shown < len(rows) else None
+        self.prev.disabled = len(self.cursors) == 1
+        self.next.disabled = self.next_cursor is None
+        return True
+
+    async def turn(self, interaction: discord.Interaction):
+        if await self.load():
+            await interaction.response.edit_message(embed=self.embed, view=self)
+        else:
+            await interaction.response.send_message("I had a database error, I'm so sorry, please try again", ephemeral=True)
+
+    @discord.ui.button(label='Prev', style=discord.ButtonStyle.grey)
+    async def prev(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if len(self.cursors) > 1:
+            self.cursors.pop()
+        await self.turn(interaction)
+
+    @discord.ui.button(label='Next', style=discord.ButtonStyle.grey)
+    async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if self.next_cursor is not None:
+            self.cursors.append(self.next_cursor)
+        await self.turn(interaction)
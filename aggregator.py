@@ -0,0 +1,80 @@
+import asyncio
+import time
+
+class Bucket:
+    __slots__ = ('guild', 'lines', 'first', 'last')
+
+    def __init__(self, guild, now: float):
+        self.guild = guild
+        self.lines = []
+        self.first = now
+        self.last = now
+
+class EventAggregator:
+    """
+    Collects lines for high-frequency events under (channel id, kind) and
+    hands each batch to `flush(channel_id, kind, guild, lines)` once no
+    new line has arrived for `debounce` seconds, or once the oldest line
+    has waited `max_latency` seconds, whichever is first.
+
+    The run loop sleeps until the next batch is due, and waits on an
+    event with no timeout at all while nothing is pending.
+    """
+    def __init__(self, flush, debounce: float=10, max_latency: float=60):
+        self.flush = flush
+        self.debounce = debounce
+        self.max_latency = max_latency
+        self.buckets = {}
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def add(self, channel_id: int, kind, guild, line: str):
+        now = time.monotonic()
+        key = (channel_id, kind)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = Bucket(guild, now)
+            # a new bucket may be due sooner than whatever the loop is
+            # sleeping towards; new lines in an old one only push it later
+            self.wakeup.set()
+        bucket.lines.append(line)
+        bucket.last = now
+
+    def due(self, bucket: Bucket):
+        return min(bucket.last + self.debounce, bucket.first + self.max_latency)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            if not self.buckets:
+                await self.wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            for key in [k for k, b in self.buckets.items() if self.due(b) <= now]:
+                bucket = self.buckets.pop(key)
+                try:
+                    await self.flush(key[0], key[1], bucket.guild, bucket.lines)
+                except Exception as e:
+                    print(f'Failed to flush {key[1]} events:')
+                    print(e)
+
+            if self.buckets:
+                timeout = min(self.due(b) for b in self.buckets.values()) - time.monotonic()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), max(timeout, 0))
+                except asyncio.TimeoutError:
+                    pass
+
+    async def close(self):
+        """Flush everything still pending and stop"""
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        buckets, self.buckets = self.buckets, {}
+        for (channel_id, kind), bucket in buckets.items():
+            await self.flush(channel_id, kind, bucket.guild, bucket.lines)
@@ -0,0 +1,72 @@
+import asyncio
+import hashlib
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+MAX_BYTES = 8 * 1024 * 1024
+CONCURRENT_DOWNLOADS = 4
+
+# hashing and image decoding both happen in here, never on the event loop
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='attachmenthash')
+_downloads = asyncio.Semaphore(CONCURRENT_DOWNLOADS)
+
+def _dhash(data: bytes):
+    """64 bit difference hash, which survives re-encoding and resizing"""
+    with Image.open(io.BytesIO(data)) as img:
+        img = img.convert('L').resize((9, 8))
+        pixels = list(img.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            bits = (bits << 1) | (left > pixels[row * 9 + col + 1])
+    return bits
+
+def _hash(data: bytes):
+    sha = hashlib.sha256(data).hexdigest()
+    phash = None
+    if Image is not None:
+        try:
+            phash = _dhash(data)
+        except Exception:
+            pass
+    return phash, sha
+
+async def hash_attachment(attachment):
+    """(perceptual hash or None, sha256 hex) for an attachment, or None if it's too big or unreadable"""
+    # nothing about an attachment short of its bytes says whether it's been
+    # seen before (every re-post gets a new id and url), so there's no cache
+    if attachment.size > MAX_BYTES:
+        return None
+    try:
+        async with _downloads:
+            data = await attachment.read()
+    except Exception as e:
+        print(f'Failed to download attachment for hashing: {e}')
+        return None
+
+    return await asyncio.get_running_loop().run_in_executor(_executor, _hash, data)
+
+async def content_signature(attachments, mode: str='exact'):
+    """
+    Signature built from what's in the files rather than their names.
+    `mode` is 'exact' (sha256) or 'perceptual' (dhash, falling back to
+    sha256 when Pillow isn't installed or can't decode the image).
+    Returns None if any attachment couldn't be hashed.
+    """
+    results = await asyncio.gather(*[hash_attachment(a) for a in attachments])
+    if None in results:
+        return None
+    parts = []
+    for phash, sha in results:
+        if mode == 'perceptual' and phash is not None:
+            parts.append(f'p{phash:016x}')
+        else:
+            parts.append(sha)
+    parts.sort()
+    return '|'.join(parts)
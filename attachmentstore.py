@@ -0,0 +1,141 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+class AttachmentStore:
+    """
+    Content addressed on-disk copies of attachments, so they can still be
+    reposted after discord's CDN stops serving them.
+
+    Files live under `blobs/` named by their sha256; `ids/` maps an
+    attachment id to the blob holding it, so the same image posted by a
+    hundred spam accounts is only stored once. The least recently used
+    blobs are dropped once the store is over `max_bytes`, and anything not
+    stored or read for `max_age` seconds is dropped by `expire`. All disk
+    work happens in a thread.
+    """
+    def __init__(self, root: str, max_bytes: int, max_age: float):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.blobs = OrderedDict()
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def _blob_path(self, digest: str):
+        return os.path.join(self.root, 'blobs', digest[:2], digest)
+
+    def _id_path(self, attachment_id: int):
+        return os.path.join(self.root, 'ids', str(attachment_id))
+
+    def _load(self):
+        os.makedirs(os.path.join(self.root, 'ids'), exist_ok=True)
+        found = []
+        for dirpath, _, filenames in os.walk(os.path.join(self.root, 'blobs')):
+            for name in filenames:
+                stat = os.stat(os.path.join(dirpath, name))
+                found.append((stat.st_mtime, name, stat.st_size))
+        found.sort()
+        for _, digest, size in found:
+            self.blobs[digest] = size
+            self.total += size
+
+    async def open(self):
+        await asyncio.to_thread(self._load)
+
+    def _remove_blob(self, digest: str):
+        size = self.blobs.pop(digest, None)
+        if size is None:
+            return
+        self.total -= size
+        try:
+            os.remove(self._blob_path(digest))
+        except FileNotFoundError:
+            pass
+
+    def _put(self, attachment_id: int, fp):
+        sha = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=self.root, delete=False) as tmp:
+            while True:
+                chunk = fp.read(64 * 1024)
+                if not chunk:
+                    break
+                sha.update(chunk)
+                tmp.write(chunk)
+            size = tmp.tell()
+        digest = sha.hexdigest()
+
+        with self.lock:
+            if digest in self.blobs:
+                os.remove(tmp.name)
+                os.utime(self._blob_path(digest))
+                self.blobs.move_to_end(digest)
+            else:
+                path = self._blob_path(digest)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp.name, path)
+                self.blobs[digest] = size
+                self.total += size
+
+            with open(self._id_path(attachment_id), 'w') as stream:
+                stream.write(digest)
+
+            while self.total > self.max_bytes and len(self.blobs) > 1:
+                self._remove_blob(next(iter(self.blobs)))
+        return digest
+
+    async def put(self, attachment_id: int, fp):
+        """Store the contents of `fp` for `attachment_id` and return its digest"""
+        return await asyncio.to_thread(self._put, attachment_id, fp)
+
+    def _get(self, attachment_id: int):
+        id_path = self._id_path(attachment_id)
+        try:
+            with open(id_path) as stream:
+                digest = stream.read()
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            if digest not in self.blobs:
+                # evicted since, the pointer is useless now
+                try: os.remove(id_path)
+                except FileNotFoundError: pass
+                return None
+            path = self._blob_path(digest)
+            os.utime(path)
+            self.blobs.move_to_end(digest)
+        return path
+
+    async def get(self, attachment_id: int):
+        """Path to the stored copy of `attachment_id`, or None"""
+        if not self.blobs:
+            return None
+        return await asyncio.to_thread(self._get, attachment_id)
+
+    def _expire(self):
+        cutoff = time.time() - self.max_age
+        with self.lock:
+            for digest in list(self.blobs):
+                try:
+                    if os.stat(self._blob_path(digest)).st_mtime >= cutoff:
+                        # blobs are in LRU order, so everything after this is newer
+                        break
+                except FileNotFoundError:
+                    pass
+                self._remove_blob(digest)
+
+        ids = os.path.join(self.root, 'ids')
+        for name in os.listdir(ids):
+            path = os.path.join(ids, name)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    async def expire(self):
+        await asyncio.to_thread(self._expire)
@@ -0,0 +1,333 @@
+"""
+Drive the bot's event handlers with fake discord objects, without
+connecting to Discord, and report throughput, latency and peak memory.
+
+    python -m bench.handlers [scenario ...] [--events N] [--rate PER_SECOND]
+
+Scenarios: message, spam, member_update, channel_update, embed (default
+all). With no --rate events are handled back to back; with one they are
+started on that schedule and left to overlap like they would live.
+
+Each scenario runs twice: once for timing and once under tracemalloc for
+peak memory, since tracing slows everything down. Log channel sends,
+deletes and timeouts complete instantly, so the numbers are the bot's own
+overhead only.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+SERVER_ID = 1
+REPORT_CHANNEL = 10
+LOG_CHANNEL = 11
+MODERATOR_ROLE = 20
+CHANNELS = 20
+USERS = 500
+
+CONFIG = {
+    'env': 'bench',
+    'token': '',
+    'server': SERVER_ID,
+    'report_channel': REPORT_CHANNEL,
+    'moderator_role': MODERATOR_ROLE,
+    'user_logs_channel': LOG_CHANNEL,
+    'role_updates_channel': LOG_CHANNEL,
+    'server_logs_channel': LOG_CHANNEL,
+    'message_deletes_channel': LOG_CHANNEL,
+    'message_edits_channel': LOG_CHANNEL,
+    'no_log_channels': [],
+    'spam_time_window': 60,
+    'spam_flag_delay': 0,
+}
+
+# nimrod reads its config at import time
+config_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+json.dump(CONFIG, config_file)
+config_file.close()
+os.environ['NIMROD_CONFIG'] = config_file.name
+
+import discord
+import metrics
+import nimrod
+import outbox
+from messagestore import MessageStore
+
+os.remove(config_file.name)
+
+class FakeAsset:
+    def __init__(self, url):
+        self.url = url
+
+class FakeRole:
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+        self.mention = f'<@&{id}>'
+
+class FakeMember(discord.Member):
+    # plain class attributes shadow discord.Member's properties so the
+    # instances can just set them
+    id = name = global_name = bot = mention = display_name = display_avatar = guild_avatar = roles = created_at = None
+
+    def __init__(self, guild, n, roles=()):
+        self.id = 900000000000000000 + n
+        self.name = f'user{n}'
+        self.global_name = f'User {n}'
+        self.display_name = self.global_name
+        self.nick = None
+        self.bot = False
+        self.mention = f'<@{self.id}>'
+        self.guild = guild
+        self.guild_avatar = None
+        self.display_avatar = FakeAsset(f'https://cdn.discordapp.com/avatars/{self.id}/a.png')
+        self.timed_out_until = None
+        self.roles = list(roles)
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+
+    def __str__(self):
+        return self.name
+
+    async def timeout(self, until, reason=None):
+        self.timed_out_until = until
+
+class FakeGuild(discord.Guild):
+    id = name = icon = roles = channels = text_channels = members = filesize_limit = None
+
+    def __init__(self):
+        self.id = SERVER_ID
+        self.name = 'Bench Server'
+        self.icon = FakeAsset('https://cdn.discordapp.com/icons/1/a.png')
+        self.roles = [FakeRole(MODERATOR_ROLE, 'Moderator'), FakeRole(21, 'Member'), FakeRole(22, 'New Account')]
+        self.channels = {i: FakeChannel(self, i) for i in range(100, 100 + CHANNELS)}
+        self.channels[REPORT_CHANNEL] = FakeChannel(self, REPORT_CHANNEL)
+        self.channels[LOG_CHANNEL] = FakeChannel(self, LOG_CHANNEL)
+        self.text_channels = list(self.channels.values())
+        self.filesize_limit = 10 * 1024**2
+        self.members = {}
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+    def get_role(self, role_id):
+        return discord.utils.get(self.roles, id=role_id)
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def get_channel_or_thread(self, channel_id):
+        return self.channels.get(channel_id)
+
+class FakeSentMessage:
+    def __init__(self, id):
+        self.id = id
+
+    async def edit(self, **kwargs):
+        pass
+
+class FakeChannel:
+    def __init__(self, guild, id):
+        self.guild = guild
+        self.id = id
+        self.name = f'channel-{id}'
+        self.type = discord.ChannelType.text
+        self.slowmode_delay = 0
+        self.changed_roles = []
+        self.overwrites = {}
+        self.sent = 0
+        self.deleted = 0
+
+    async def send(self, view=None, **kwargs):
+        self.sent += 1
+        if view:
+            # nobody is going to press the report buttons
+            view.stop()
+        return FakeSentMessage(self.sent)
+
+    async def delete_messages(self, messages, reason=None):
+        self.deleted += len(messages)
+
+    def overwrites_for(self, role):
+        return self.overwrites.get(role.name, discord.PermissionOverwrite())
+
+class FakeAttachment:
+    def __init__(self, id, filename, size):
+        self.id = id
+        self.filename = filename
+        self.size = size
+        self.width = 1024
+        self.url = f'https://cdn.discordapp.com/attachments/1/{id}/{filename}?ex=6700000&is=6600000&hm=' + 'a' * 64
+
+    async def read(self):
+        return b'\0' * 1024
+
+class FakeMessage:
+    def __init__(self, id, author, channel, content='', attachments=()):
+        self.id = id
+        self.author = author
+        self.guild = channel.guild
+        self.channel = channel
+        self.content = content
+        self.attachments = list(attachments)
+        self.stickers = []
+        self.poll = None
+        self.reference = None
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+        self.edited_at = None
+        self.jump_url = f'https://discord.com/channels/{SERVER_ID}/{channel.id}/{id}'
+
+def make_members(guild):
+    members = [FakeMember(guild, n, roles=[guild.roles[1]]) for n in range(USERS)]
+    guild.members = {m.id: m for m in members}
+    return members
+
+def message_events(guild, count):
+    members = make_members(guild)
+    channels = [guild.channels[100 + i] for i in range(CHANNELS)]
+    return [
+        (FakeMessage(1100000000000000000 + n, members[n % USERS], channels[n % CHANNELS], f'message number {n} with some ordinary chatter in it'),)
+        for n in range(count)
+    ]
+
+def spam_events(guild, count):
+    # every user posts the same four images three times, which is what the
+    # default rule flags, so a third of these messages start a flag_and_mute
+    members = make_members(guild)
+    channels = [guild.channels[100 + i] for i in range(CHANNELS)]
+    events = []
+    for n in range(count):
+        author = members[(n // 3) % USERS]
+        images = [FakeAttachment(1200000000000000000 + n * 4 + i, f'image_{i}.png', 180000 + i) for i in range(4)]
+        events.append((FakeMessage(1100000000000000000 + n, author, channels[n % CHANNELS], attachments=images),))
+    return events
+
+def member_update_events(guild, count):
+    members = make_members(guild)
+    events = []
+    for n in range(count):
+        before = members[n % USERS]
+        after = FakeMember(guild, n % USERS, roles=before.roles)
+        if n % 2:
+            after.nick = f'nick {n}'
+        else:
+            after.roles = before.roles[1:] if before.roles else [guild.roles[1]]
+        members[n % USERS] = after
+        events.append((before, after))
+    return events
+
+def channel_update_events(guild, count):
+    role = guild.roles[1]
+    events = []
+    for n in range(count):
+        before = FakeChannel(guild, 100 + n % CHANNELS)
+        after = FakeChannel(guild, before.id)
+        before.overwrites[role.name] = discord.PermissionOverwrite(send_messages=bool(n % 2))
+        after.overwrites[role.name] = discord.PermissionOverwrite(send_messages=not n % 2)
+        after.changed_roles = [role]
+        after.slowmode_delay = n % 3
+        events.append((before, after))
+    return events
+
+def embed_events(guild, count):
+    members = make_members(guild)
+    return [('yellow', members[n % USERS], f'embed number {n}') for n in range(count)]
+
+async def make_embed(*args):
+    nimrod.make_embed(*args)
+
+SCENARIOS = {
+    'message': (lambda: nimrod.on_message, message_events),
+    'spam': (lambda: nimrod.on_message, spam_events),
+    'member_update': (lambda: nimrod.on_member_update, member_update_events),
+    'channel_update': (lambda: nimrod.on_guild_channel_update, channel_update_events),
+    'embed': (lambda: make_embed, embed_events),
+}
+
+def reset(guild):
+    nimrod.bot.outbox = outbox.Outbox()
+    nimrod.guilds = {guild.id: nimrod.guild_state(nimrod.config, guild, {})}
+    nimrod.update_targets()
+    nimrod.message_store = MessageStore(nimrod.config.message_store_bytes)
+    nimrod.events.buckets.clear()
+    for t in metrics.timers.values():
+        t.__init__(t.name)
+
+async def settle(ignore=()):
+    """Wait for whatever the handlers started (flag_and_mute, outbox workers) to finish"""
+    current = asyncio.current_task()
+    while True:
+        pending = [t for t in asyncio.all_tasks() if t is not current and t not in ignore]
+        if not pending:
+            return
+        await asyncio.wait(pending)
+
+async def drive(handler, events, rate):
+    latencies = []
+
+    async def one(args):
+        start = time.perf_counter()
+        await handler(*args)
+        latencies.append(time.perf_counter() - start)
+
+    began = time.perf_counter()
+    for i, args in enumerate(events):
+        if rate:
+            delay = began + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            asyncio.create_task(one(args))
+        else:
+            await one(args)
+    await settle()
+    return time.perf_counter() - began, latencies
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+async def run(name, count, rate):
+    get_handler, build = SCENARIOS[name]
+    handler = get_handler()
+
+    guild = FakeGuild()
+    reset(guild)
+    events = build(guild, count)
+    elapsed, latencies = await drive(handler, events, rate)
+    latencies.sort()
+    flags = metrics.timer('flag_and_mute')
+    flag_runs = flags.count
+    flag_avg = flags.total / flags.count if flags.count else 0
+    flag_p99 = flags.quantile(0.99)
+    sends = nimrod.bot.outbox.requests
+
+    guild = FakeGuild()
+    reset(guild)
+    events = build(guild, count)
+    tracemalloc.start()
+    await drive(handler, events, rate)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f'{name}: {count} events in {elapsed:.3f}s, {count / elapsed:,.0f}/s')
+    print(f'  latency p50 {percentile(latencies, 0.5) * 1e6:8.1f}us  p99 {percentile(latencies, 0.99) * 1e6:8.1f}us  max {latencies[-1] * 1e6:8.1f}us')
+    print(f'  peak memory {peak / 1024:,.1f} KiB, {sends} log sends')
+    if flag_runs:
+        print(f'  flag_and_mute {flag_runs} runs, avg {metrics.format_seconds(flag_avg)}, p99 under {metrics.format_seconds(flag_p99)}')
+
+async def main(args):
+    for name in args.scenarios or SCENARIOS:
+        await run(name, args.events, args.rate)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the event handlers offline')
+    parser.add_argument('scenarios', nargs='*', metavar='scenario')
+    parser.add_argument('--events', type=int, default=5000)
+    parser.add_argument('--rate', type=float, default=0, help='events per second, 0 to run them back to back')
+    args = parser.parse_args()
+    if any(s not in SCENARIOS for s in args.scenarios):
+        sys.exit(f'Unknown scenario, pick from: {", ".join(SCENARIOS)}')
+    asyncio.run(main(args))
@@ -0,0 +1,82 @@
+"""
+Time /modstats against warnings tables of increasing size: the rollups
+from schema migration 6 next to the GROUP BY over warnings they replace,
+plus what keeping the rollups up to date adds to each add_warn.
+
+    python -m bench.modstats [sizes...]
+"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+import nimroddb
+
+SERVER_ID = 1
+USERS = 20000
+MODERATORS = 20
+LOOKUPS = 50
+WRITES = 500
+ACTIONS = list(nimroddb.ACTION_TYPES)
+# a busy server, so a bigger table means a longer history rather than a
+# busier month
+PER_DAY = 300
+NOW = 1700000000
+
+async def fill(rows: int):
+    batch = []
+    async with nimroddb.transaction() as db:
+        for i in range(rows):
+            batch.append((str(uuid.uuid4()), SERVER_ID, random.randrange(USERS), random.randrange(MODERATORS), NOW - (rows - i) * 86400 // PER_DAY, 'bench warning', random.choice(ACTIONS)))
+            if len(batch) == 5000 or i == rows - 1:
+                await db.executemany('INSERT INTO warnings (id, server_id, user_id, moderator_id, datestamp, reason, action_type) VALUES (?, ?, ?, ?, ?, ?, ?)', batch)
+                batch = []
+        await db.execute('ANALYZE')
+
+async def group_by(since: int):
+    async with nimroddb.reader() as db:
+        async with db.execute('SELECT moderator_id, action_type, COUNT(*) FROM warnings WHERE server_id = ? AND datestamp >= ? GROUP BY moderator_id, action_type', (SERVER_ID, since * 86400)) as cursor:
+            await cursor.fetchall()
+        async with db.execute('SELECT user_id, COUNT(*) AS total FROM warnings WHERE server_id = ? AND datestamp >= ? GROUP BY user_id HAVING total >= 2 ORDER BY total DESC LIMIT 10', (SERVER_ID, since * 86400)) as cursor:
+            await cursor.fetchall()
+
+async def rollups(since: int):
+    await nimroddb.mod_stats(SERVER_ID, since)
+    await nimroddb.repeat_offenders(SERVER_ID, since)
+
+async def timed(func, windows):
+    start = time.perf_counter()
+    for since in windows:
+        await func(since)
+    return (time.perf_counter() - start) / len(windows) * 1000
+
+async def writes():
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        nimroddb.add_warn(SERVER_ID, random.randrange(USERS), random.randrange(MODERATORS), NOW, 'bench warning', action_type=random.choice(ACTIONS))
+        for _ in range(WRITES)
+    ])
+    return (time.perf_counter() - start) / WRITES * 1000
+
+async def run(rows: int, schema: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        await nimroddb.connect(os.path.join(tmp, 'bench.db'), schema=schema)
+        await fill(rows)
+        windows = [NOW // 86400 - random.choice([1, 7, 30]) + 1 for _ in range(LOOKUPS)]
+        lookup = await timed(rollups if schema >= 6 else group_by, windows)
+        write = await writes()
+        await nimroddb.close()
+    return lookup, write
+
+async def main(sizes):
+    print(f'{"rows":>10} {"GROUP BY (ms)":>14} {"rollups (ms)":>14} {"add_warn (ms)":>14} {"+rollups (ms)":>14}')
+    for rows in sizes:
+        plain, plain_write = await run(rows, 5)
+        rolled, rolled_write = await run(rows, len(nimroddb.MIGRATIONS))
+        print(f'{rows:>10} {plain:>14.3f} {rolled:>14.3f} {plain_write:>14.3f} {rolled_write:>14.3f}')
+
+if __name__ == '__main__':
+    sizes = [int(s) for s in sys.argv[1:]] or [10000, 100000, 500000]
+    asyncio.run(main(sizes))
@@ -0,0 +1,198 @@
+"""
+Feed a recording made with `record_events` back through the handlers,
+against the fake discord objects from bench.handlers and a scratch copy
+of the database, at the original pace or faster.
+
+    python -m bench.replay events.jsonl.gz [--speed N] [--db PATH]
+
+--speed 1 keeps the recorded timing, 10 plays it ten times as fast and 0
+as fast as the handlers can take it. Reports throughput, how far behind
+schedule the replay fell, latency per event type and the busiest
+handlers and database calls.
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from bench.handlers import FakeAsset, FakeAttachment, FakeChannel, FakeGuild, FakeMember, FakeMessage, FakeRole, percentile, reset, settle
+import discord
+import metrics
+import nimrod
+import nimroddb
+import recorder
+from messagestore import MessageStore
+
+class StubResponse:
+    status = 200
+
+    def __init__(self, size):
+        self.content_length = size
+        self.content = self
+
+    async def iter_chunked(self, size):
+        remaining = self.content_length
+        while remaining > 0:
+            yield b'\0' * min(size, remaining)
+            remaining -= size
+
+class StubSession:
+    """Answers every attachment download with zeroes, instantly"""
+    def get(self, url):
+        return self
+
+    async def __aenter__(self):
+        return StubResponse(64 * 1024)
+
+    async def __aexit__(self, *exc):
+        return False
+
+class Raw:
+    """Stand-in for discord.py's Raw*Event payloads"""
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+class Replay:
+    def __init__(self, guild: FakeGuild):
+        self.guild = guild
+        self.roles = {r.name: r for r in guild.roles}
+
+    def role(self, name):
+        role = self.roles.get(name)
+        if role is None:
+            role = self.roles[name] = FakeRole(len(self.roles) + 1000, name)
+            self.guild.roles.append(role)
+        return role
+
+    def channel(self, channel_id):
+        channel = self.guild.channels.get(channel_id)
+        if channel is None:
+            channel = self.guild.channels[channel_id] = FakeChannel(self.guild, channel_id)
+        return channel
+
+    def member(self, data):
+        member = FakeMember(self.guild, 0, roles=[self.role(name) for name in data['roles']])
+        member.id = data['id']
+        member.name = data['name']
+        member.global_name = member.display_name = data['name']
+        member.mention = f'<@{member.id}>'
+        member.bot = data['bot']
+        member.nick = data['nick']
+        if data['avatar']:
+            member.guild_avatar = FakeAsset(f'https://cdn.discordapp.com/guilds/1/users/{member.id}/a.png')
+        if data['timed_out_until']:
+            member.timed_out_until = datetime.datetime.fromtimestamp(data['timed_out_until'], datetime.timezone.utc)
+        member.created_at = datetime.datetime.fromtimestamp(data['created_at'], datetime.timezone.utc)
+        self.guild.members[member.id] = member
+        return member
+
+    def message(self, data):
+        attachments = []
+        for attachment_id, filename, size, width in data['attachments']:
+            attachment = FakeAttachment(attachment_id, filename, size)
+            attachment.width = width
+            attachments.append(attachment)
+        message = FakeMessage(data['id'], self.member(data['author']), self.channel(data['channel']), data['content'], attachments)
+        if data['reference']:
+            message.reference = Raw(message_id=data['reference'])
+        if data['edited']:
+            message.edited_at = datetime.datetime.fromtimestamp(data['edited'], datetime.timezone.utc)
+        return message
+
+    def build(self, event, data):
+        """The handler and its arguments for one recorded event"""
+        if event == 'message':
+            return nimrod.on_message, (self.message(data),)
+        if event == 'raw_message_edit':
+            return nimrod.on_raw_message_edit, (Raw(message=self.message(data)),)
+        if event == 'raw_message_delete':
+            return nimrod.on_raw_message_delete, (Raw(message_id=data['id'], channel_id=data['channel'], guild_id=self.guild.id),)
+        if event == 'raw_bulk_message_delete':
+            return nimrod.on_raw_bulk_message_delete, (Raw(message_ids=set(data['ids']), channel_id=data['channel'], guild_id=self.guild.id),)
+        if event == 'member_update':
+            return nimrod.on_member_update, (self.member(data['before']), self.member(data['after']))
+        if event == 'member_join':
+            return nimrod.on_member_join, (self.member(data['member']),)
+        if event == 'raw_member_remove':
+            return nimrod.on_raw_member_remove, (Raw(user=self.member(data['member']), guild_id=self.guild.id),)
+        return None, None
+
+async def replay(path: str, speed: float):
+    guild = FakeGuild()
+    reset(guild)
+    nimrod.message_store = MessageStore(nimrod.config.message_store_bytes, spill=True)
+    # the delete logs look the guild and author up on the client
+    nimrod.bot.get_guild = lambda guild_id: guild
+    nimrod.bot.get_user = lambda user_id: None
+    nimrod.bot.http_session = StubSession()
+    player = Replay(guild)
+
+    latencies = defaultdict(list)
+    lag = []
+
+    async def one(event, handler, args):
+        start = time.perf_counter()
+        try:
+            await handler(*args)
+        except Exception as e:
+            print(f'{event} failed: {e}')
+        latencies[event].append(time.perf_counter() - start)
+
+    first = None
+    began = time.perf_counter()
+    count = 0
+    for timestamp, event, data in recorder.read(path):
+        handler, args = player.build(event, data)
+        if handler is None:
+            continue
+        if first is None:
+            first = timestamp
+        if speed:
+            due = began + (timestamp - first) / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                lag.append(-delay)
+            asyncio.create_task(one(event, handler, args))
+        else:
+            await one(event, handler, args)
+        count += 1
+        # let the write-behind batcher and outbox run between events
+        if not count % 100:
+            await asyncio.sleep(0)
+    await settle(ignore={nimroddb._write_task})
+    await nimrod.message_store.flush()
+    elapsed = time.perf_counter() - began
+
+    print(f'{count} events in {elapsed:.2f}s, {count / elapsed:,.0f}/s, {nimrod.bot.outbox.requests} log sends')
+    if lag:
+        lag.sort()
+        print(f'fell behind schedule on {len(lag)} events, p50 {lag[len(lag) // 2] * 1000:.1f}ms, max {lag[-1] * 1000:.1f}ms')
+    for event, values in sorted(latencies.items()):
+        values.sort()
+        print(f'  {event:24} {len(values):7} p50 {percentile(values, 0.5) * 1e6:8.1f}us  p99 {percentile(values, 0.99) * 1e6:8.1f}us')
+    print('busiest:')
+    for line in metrics.summary(10):
+        print(f'  {line}')
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        await nimroddb.connect(args.db or os.path.join(tmp, 'replay.db'))
+        try:
+            await replay(args.recording, args.speed)
+        finally:
+            await nimroddb.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded gateway events through the handlers')
+    parser.add_argument('recording')
+    parser.add_argument('--speed', type=float, default=1, help='1 for the recorded pace, 0 for as fast as possible')
+    parser.add_argument('--db', help='database to replay against (default a scratch one)')
+    args = parser.parse_args()
+    if not os.path.exists(args.recording):
+        sys.exit(f'No such recording: {args.recording}')
+    asyncio.run(main(args))
@@ -0,0 +1,78 @@
+"""
+Compare the memory held by the spam tracker when it kept whole messages
+around against the compact SpamRecord layout.
+
+    python -m bench.spam_tracker_memory [messages]
+
+The "old" layout is approximated with plain objects carrying the fields a
+discord.Message with four image attachments drags along; a real Message
+also pins its member, embeds and cached guild state, so if anything the
+old numbers here are an underestimate.
+"""
+import datetime
+import sys
+import tracemalloc
+import time
+from spamtracker import SpamRecord, SpamTracker, signature_hash
+
+class FakeAttachment:
+    def __init__(self, i, n):
+        self.id = 1200000000000000000 + n * 4 + i
+        self.filename = f'image_{i}.png'
+        self.size = 180000 + i
+        self.width = 1024
+        self.height = 768
+        self.content_type = 'image/png'
+        self.url = f'https://cdn.discordapp.com/attachments/1/{self.id}/{self.filename}?ex=6700000&is=6600000&hm=' + 'a' * 64
+        self.proxy_url = self.url.replace('cdn.discordapp.com', 'media.discordapp.net')
+
+class FakeAuthor:
+    def __init__(self, n):
+        self.id = 900000000000000000 + n
+        self.name = f'user{n}'
+        self.global_name = f'User {n}'
+        self.nick = None
+        self.roles = [object() for _ in range(3)]
+
+class FakeMessage:
+    def __init__(self, n):
+        self.id = 1100000000000000000 + n
+        self.channel_id = 800000000000000000 + n % 20
+        self.author = FakeAuthor(n % 500)
+        self.content = ''
+        self.attachments = [FakeAttachment(i, n) for i in range(4)]
+        self.embeds = []
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+
+def old_layout(count):
+    tracker = {}
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for n in range(count):
+        message = FakeMessage(n)
+        signature = '|'.join(sorted(f'{a.filename}_{a.size}' for a in message.attachments))
+        tracker.setdefault(message.author.id, []).append((signature, now, message))
+    return tracker
+
+def new_layout(count):
+    tracker = SpamTracker()
+    for n in range(count):
+        message = FakeMessage(n)
+        signature = signature_hash('|'.join(sorted(f'{a.filename}_{a.size}' for a in message.attachments)))
+        tracker.add(message.author.id, SpamRecord(signature, time.monotonic(), message.channel_id, message.id))
+    return tracker
+
+def measure(build, count):
+    tracemalloc.start()
+    kept = build(count)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return current
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    old = measure(old_layout, count)
+    new = measure(new_layout, count)
+    print(f'{count} tracked messages')
+    print(f'  old (signature str, datetime, Message): {old / 1024:10.1f} KiB  {old / count:7.1f} B/msg')
+    print(f'  new (SpamRecord):                       {new / 1024:10.1f} KiB  {new / count:7.1f} B/msg')
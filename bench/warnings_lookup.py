@@ -0,0 +1,57 @@
+"""
+Time /warnings lookups against warnings tables of increasing size, with and
+without the indexes added by schema migration 2.
+
+    python -m bench.warnings_lookup [sizes...]
+"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+import nimroddb
+
+SERVER_ID = 1
+USERS = 5000
+LOOKUPS = 200
+
+async def fill(rows: int):
+    batch = []
+    async with nimroddb.transaction() as db:
+        for i in range(rows):
+            warn_id = str(uuid.uuid4())
+            batch.append((warn_id, SERVER_ID, random.randrange(USERS), 42, 1700000000 + i, f'bench warning {i}'))
+            if len(batch) == 5000:
+                await db.executemany('INSERT INTO warnings (id, server_id, user_id, moderator_id, datestamp, reason) VALUES (?, ?, ?, ?, ?, ?)', batch)
+                await db.executemany('INSERT INTO warn_message (warn_id, channel_id, message_id) VALUES (?, 1, 1)', [(b[0],) for b in batch])
+                batch = []
+        if batch:
+            await db.executemany('INSERT INTO warnings (id, server_id, user_id, moderator_id, datestamp, reason) VALUES (?, ?, ?, ?, ?, ?)', batch)
+            await db.executemany('INSERT INTO warn_message (warn_id, channel_id, message_id) VALUES (?, 1, 1)', [(b[0],) for b in batch])
+
+async def run(rows: int, schema: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        await nimroddb.connect(path, schema=schema)
+        await fill(rows)
+
+        users = [random.randrange(USERS) for _ in range(LOOKUPS)]
+        start = time.perf_counter()
+        for user_id in users:
+            await nimroddb.list_warns(SERVER_ID, user_id)
+        elapsed = time.perf_counter() - start
+        await nimroddb.close()
+    return elapsed / LOOKUPS * 1000
+
+async def main(sizes):
+    print(f'{"rows":>10} {"no index (ms)":>15} {"indexed (ms)":>15}')
+    for rows in sizes:
+        plain = await run(rows, 1)
+        indexed = await run(rows, len(nimroddb.MIGRATIONS))
+        print(f'{rows:>10} {plain:>15.3f} {indexed:>15.3f}')
+
+if __name__ == '__main__':
+    sizes = [int(s) for s in sys.argv[1:]] or [1000, 10000, 100000, 500000]
+    asyncio.run(main(sizes))
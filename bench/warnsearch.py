@@ -0,0 +1,88 @@
+"""
+Time /warnsearch against warnings tables of increasing size: the full
+text search and action type index from schema migration 5, next to the
+LIKE scan the same search would need without them.
+
+    python -m bench.warnsearch [sizes...]
+"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+import nimroddb
+
+SERVER_ID = 1
+USERS = 5000
+MODERATORS = 20
+SEARCHES = 50
+PAGE = 11
+
+TOPICS = 'spam scam links nsfw rude spoilers trading selling begging toxic insults slurs harassment flooding caps pinging images gifs advertising impersonation'.split()
+# the rest of a reason is free text, made up of words from a larger vocabulary
+FILLER = [f'word{i}' for i in range(2000)]
+PREFIXES = {'warn': '', 'flag': '(FLAG) ', 'mute': '(MUTE) ', 'ban': '(BAN) '}
+QUERIES = ['scam', 'scam links', 'trad*', 'harassment slurs']
+
+async def fill(rows: int):
+    actions = list(PREFIXES)
+    batch = []
+    async with nimroddb.transaction() as db:
+        for i in range(rows):
+            action = random.choice(actions)
+            words = random.sample(TOPICS, random.randint(1, 2)) + random.choices(FILLER, k=random.randint(2, 10))
+            random.shuffle(words)
+            reason = PREFIXES[action] + ' '.join(words)
+            batch.append((str(uuid.uuid4()), SERVER_ID, random.randrange(USERS), random.randrange(MODERATORS), 1700000000 + i * 60, reason, action))
+            if len(batch) == 5000 or i == rows - 1:
+                await db.executemany('INSERT INTO warnings (id, server_id, user_id, moderator_id, datestamp, reason, action_type) VALUES (?, ?, ?, ?, ?, ?, ?)', batch)
+                batch = []
+        await db.execute('ANALYZE')
+
+async def like_scan(text: str, action_type: str):
+    query = 'SELECT id, reason FROM warnings WHERE server_id = ?'
+    params = [SERVER_ID]
+    for word in text.split():
+        query += ' AND reason LIKE ?'
+        params.append(f'%{word.rstrip("*")}%')
+    if action_type == 'ban':
+        query += " AND reason LIKE '(BAN)%'"
+    query += ' ORDER BY datestamp DESC LIMIT ?'
+    params.append(PAGE)
+    async with nimroddb.reader() as db:
+        async with db.execute(query, params) as cursor:
+            await cursor.fetchall()
+        async with db.execute(query.replace('SELECT id, reason', 'SELECT COUNT(*)').rsplit(' ORDER BY', 1)[0], params[:-1]) as cursor:
+            await cursor.fetchone()
+
+async def search(text: str, action_type: str):
+    await nimroddb.search_warns(SERVER_ID, text, action_type=action_type, limit=PAGE)
+    await nimroddb.count_search(SERVER_ID, text, action_type=action_type)
+
+async def timed(func, searches):
+    start = time.perf_counter()
+    for text, action_type in searches:
+        await func(text, action_type)
+    return (time.perf_counter() - start) / len(searches) * 1000
+
+async def run(rows: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        await nimroddb.connect(os.path.join(tmp, 'bench.db'))
+        await fill(rows)
+        searches = [(random.choice(QUERIES), random.choice([None, 'ban'])) for _ in range(SEARCHES)]
+        like = await timed(like_scan, searches)
+        fts = await timed(search, searches)
+        await nimroddb.close()
+    return like, fts
+
+async def main(sizes):
+    print(f'{"rows":>10} {"LIKE scan (ms)":>15} {"FTS5 (ms)":>15}')
+    for rows in sizes:
+        like, fts = await run(rows)
+        print(f'{rows:>10} {like:>15.3f} {fts:>15.3f}')
+
+if __name__ == '__main__':
+    sizes = [int(s) for s in sys.argv[1:]] or [1000, 10000, 100000, 500000]
+    asyncio.run(main(sizes))
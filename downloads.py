@@ -0,0 +1,104 @@
+import asyncio
+import io
+import shutil
+import tempfile
+import zipfile
+
+CHUNK_SIZE = 64 * 1024
+SPOOL_BYTES = 1024 * 1024
+CONCURRENT_DOWNLOADS = 4
+
+OK = 'ok'
+TOO_LARGE = 'too large'
+FAILED = 'failed'
+
+class Download:
+    """One requested file and what happened to it. `fp` is only set when status is OK"""
+    __slots__ = ('url', 'filename', 'size', 'status', 'fp')
+
+    def __init__(self, url: str, filename: str, size: int=None):
+        self.url = url
+        self.filename = filename
+        self.size = size
+        self.status = FAILED
+        self.fp = None
+
+async def _fetch(session, item: Download, max_bytes: int, semaphore: asyncio.Semaphore):
+    # small files stay in memory, anything bigger is moved to a temp file
+    # so a bulk delete full of videos doesn't all sit in RAM at once
+    fp = io.BytesIO()
+    size = 0
+    try:
+        async with semaphore:
+            async with session.get(item.url) as resp:
+                if resp.status != 200:
+                    return
+                if resp.content_length and resp.content_length > max_bytes:
+                    item.status = TOO_LARGE
+                    return
+                async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        item.status = TOO_LARGE
+                        fp.close()
+                        return
+                    if isinstance(fp, io.BytesIO) and size > SPOOL_BYTES:
+                        spooled = tempfile.TemporaryFile()
+                        spooled.write(fp.getvalue())
+                        fp = spooled
+                    fp.write(chunk)
+    except Exception as e:
+        print(f'Failed to download {item.url}: {e}')
+        fp.close()
+        return
+
+    fp.seek(0)
+    item.size = size
+    item.fp = fp
+    item.status = OK
+
+async def download_all(session, items: list, max_file_bytes: int, max_total_bytes: int):
+    """
+    Download `items` concurrently over the shared `session`. Files whose
+    known size is over `max_file_bytes`, or that would push the total over
+    `max_total_bytes`, are never fetched and come back TOO_LARGE.
+    """
+    semaphore = asyncio.Semaphore(CONCURRENT_DOWNLOADS)
+    budget = max_total_bytes
+    wanted = []
+    for item in items:
+        if item.size is not None and (item.size > max_file_bytes or item.size > budget):
+            item.status = TOO_LARGE
+            continue
+        if item.size is not None:
+            budget -= item.size
+        wanted.append(item)
+
+    await asyncio.gather(*[_fetch(session, item, min(max_file_bytes, max_total_bytes), semaphore) for item in wanted])
+
+    # unknown sizes (stickers) are only checked against the total once we have them
+    total = 0
+    for item in items:
+        if item.status != OK:
+            continue
+        if total + item.size > max_total_bytes:
+            item.fp.close()
+            item.fp = None
+            item.status = TOO_LARGE
+            continue
+        total += item.size
+    return items
+
+def _zip(entries: list):
+    fp = tempfile.TemporaryFile()
+    with zipfile.ZipFile(fp, 'w', zipfile.ZIP_STORED) as bundle:
+        for name, source in entries:
+            with bundle.open(name, 'w') as out:
+                shutil.copyfileobj(source, out, CHUNK_SIZE)
+            source.close()
+    fp.seek(0)
+    return fp
+
+async def zip_files(entries: list):
+    """Bundle (name, file object) pairs into one uncompressed zip in a temp file, closing the sources"""
+    return await asyncio.to_thread(_zip, entries)
@@ -0,0 +1,150 @@
+import json
+import nimroddb
+from collections import OrderedDict
+
+# rough per-object overheads, only used to keep the store near its budget
+RECORD_BYTES = 250
+ATTACHMENT_BYTES = 150
+
+class StoredAttachment:
+    __slots__ = ('id', 'filename', 'url', 'size')
+
+    def __init__(self, id: int, filename: str, url: str, size: int):
+        self.id = id
+        self.filename = filename
+        self.url = url
+        self.size = size
+
+class StoredMessage:
+    """What the delete and edit logs need from a message, and nothing else"""
+    __slots__ = ('id', 'guild_id', 'channel_id', 'author_id', 'author_name', 'content', 'created_at', 'reference_id', 'attachments', 'sticker')
+
+    def __init__(self, id: int, guild_id: int, channel_id: int, author_id: int, author_name: str, content: str, created_at: int, reference_id: int=None, attachments: tuple=(), sticker: tuple=None):
+        self.id = id
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.author_id = author_id
+        self.author_name = author_name
+        self.content = content
+        self.created_at = created_at
+        self.reference_id = reference_id
+        self.attachments = attachments
+        self.sticker = sticker
+
+    @classmethod
+    def from_message(cls, message):
+        content = message.content
+        if message.poll:
+            content += '\n**poll**'
+            content += f'\n_Question_: {message.poll.question}'
+            for answer in message.poll.answers:
+                content += f'\n_Answer_: {answer.text}'
+        sticker = None
+        if message.stickers:
+            sticker = (message.stickers[0].name, message.stickers[0].url)
+        return cls(
+            message.id,
+            message.guild.id if message.guild else None,
+            message.channel.id,
+            message.author.id,
+            str(message.author),
+            content,
+            round(message.created_at.timestamp()),
+            message.reference.message_id if message.reference else None,
+            tuple(StoredAttachment(a.id, a.filename, a.url, a.size) for a in message.attachments),
+            sticker
+        )
+
+    @classmethod
+    def from_row(cls, row):
+        attachments = tuple(StoredAttachment(*a) for a in json.loads(row['attachments']))
+        sticker = tuple(json.loads(row['sticker'])) if row['sticker'] else None
+        return cls(row['id'], row['guild_id'], row['channel_id'], row['author_id'], row['author_name'], row['content'], row['created_at'], row['reference_id'], attachments, sticker)
+
+    def row(self):
+        attachments = json.dumps([(a.id, a.filename, a.url, a.size) for a in self.attachments])
+        sticker = json.dumps(self.sticker) if self.sticker else None
+        return (self.id, self.guild_id, self.channel_id, self.author_id, self.author_name, self.content, self.created_at, self.reference_id, attachments, sticker)
+
+    def size(self):
+        size = RECORD_BYTES + len(self.content) + len(self.author_name)
+        for a in self.attachments:
+            size += ATTACHMENT_BYTES + len(a.filename) + len(a.url)
+        return size
+
+class MessageStore:
+    """
+    Recent messages kept so edits and deletes can still be logged once
+    discord.py's own cache has forgotten them. The most recently seen
+    messages stay in memory up to roughly `max_bytes`; with `spill` on,
+    anything pushed out is written to the database by `flush` and looked
+    up there on a miss.
+    """
+    def __init__(self, max_bytes: int, spill: bool=False):
+        self.max_bytes = max_bytes
+        self.spill = spill
+        self.messages = OrderedDict()
+        self.bytes = 0
+        # pushed out of memory but not written to the database yet
+        self.evicted = {}
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add(self, record: StoredMessage):
+        old = self.messages.pop(record.id, None)
+        if old is not None:
+            self.bytes -= old.size()
+        self.evicted.pop(record.id, None)
+        self.messages[record.id] = record
+        self.bytes += record.size()
+
+        while self.bytes > self.max_bytes and len(self.messages) > 1:
+            _, old = self.messages.popitem(last=False)
+            self.bytes -= old.size()
+            if self.spill:
+                self.evicted[old.id] = old
+
+    async def get(self, message_id: int):
+        record = self.messages.get(message_id)
+        if record is not None:
+            self.messages.move_to_end(message_id)
+            return record
+        record = self.evicted.get(message_id)
+        if record is None and self.spill:
+            row = await nimroddb.get_stored_message(message_id)
+            if row:
+                record = StoredMessage.from_row(row)
+        return record
+
+    async def pop(self, message_id: int):
+        return (await self.pop_many([message_id]))[0]
+
+    async def pop_many(self, message_ids: list):
+        """The stored records for `message_ids` (None where unknown), forgetting them"""
+        found = {}
+        missing = []
+        for message_id in message_ids:
+            record = self.messages.pop(message_id, None)
+            if record is not None:
+                self.bytes -= record.size()
+            else:
+                record = self.evicted.pop(message_id, None)
+            if record is not None:
+                found[message_id] = record
+            else:
+                missing.append(message_id)
+
+        if self.spill:
+            if missing:
+                for row in await nimroddb.get_stored_messages(missing) or []:
+                    found[row['id']] = StoredMessage.from_row(row)
+            await nimroddb.delete_stored_messages(list(message_ids))
+        return [found.get(message_id) for message_id in message_ids]
+
+    async def flush(self, max_age: float=None):
+        """Write everything pushed out of memory to the database, and drop spilled messages older than `max_age` seconds"""
+        if not self.spill:
+            return
+        evicted, self.evicted = self.evicted, {}
+        await nimroddb.store_messages([r.row() for r in evicted.values()], max_age)
@@ -0,0 +1,140 @@
+import bisect
+import contextlib
+import functools
+import os
+import time
+
+# histogram bucket upper bounds in seconds
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Timer:
+    """Call count, errors, calls in flight and a latency histogram for one function"""
+    __slots__ = ('name', 'count', 'errors', 'in_flight', 'total', 'buckets')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.total = 0.0
+        # one slot per bucket, plus one for anything slower than the last
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def quantile(self, q: float):
+        """Upper bound of the bucket holding the q-th quantile (inf when it's past the last bucket)"""
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+timers = {}
+started = time.time()
+
+def timer(name: str):
+    t = timers.get(name)
+    if t is None:
+        t = timers[name] = Timer(name)
+    return t
+
+def timed(name: str):
+    """Decorator recording every call of an async function under `name`"""
+    def decorator(func):
+        t = timer(name)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            t.in_flight += 1
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except BaseException:
+                t.errors += 1
+                raise
+            finally:
+                t.in_flight -= 1
+                t.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def instrument(module, names: list, prefix: str):
+    """Swap each of `module`'s functions in `names` for a timed version"""
+    for name in names:
+        setattr(module, name, timed(f'{prefix}.{name}')(getattr(module, name)))
+
+@contextlib.contextmanager
+def phase(name: str):
+    """Time a block of one-off work, like a step of startup, under `name`"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer(name).observe(time.perf_counter() - start)
+
+def format_seconds(seconds: float):
+    if seconds == float('inf'):
+        return f'>{BUCKETS[-1]}s'
+    if seconds < 1:
+        return f'{seconds * 1000:.1f}ms'
+    return f'{seconds:.2f}s'
+
+def summary(limit: int=25):
+    """One line per timer, busiest first"""
+    lines = []
+    for t in sorted(timers.values(), key=lambda t: t.total, reverse=True)[:limit]:
+        if not t.count and not t.in_flight:
+            continue
+        line = f'`{t.name}` {t.count} calls, avg {format_seconds(t.total / t.count) if t.count else "-"}, p50 {format_seconds(t.quantile(0.5))}, p99 {format_seconds(t.quantile(0.99))}'
+        if t.errors:
+            line += f', **{t.errors} errors**'
+        if t.in_flight:
+            line += f', {t.in_flight} running'
+        lines.append(line)
+    return lines
+
+def prometheus(gauges: dict=None):
+    """Everything in the Prometheus text exposition format. Names in `gauges` ending in _total are reported as counters"""
+    out = [
+        '# HELP nimrod_call_seconds Time spent in instrumented handlers and database calls',
+        '# TYPE nimrod_call_seconds histogram',
+    ]
+    for t in timers.values():
+        seen = 0
+        for bound, count in zip(BUCKETS, t.buckets):
+            seen += count
+            out.append(f'nimrod_call_seconds_bucket{{name="{t.name}",le="{bound}"}} {seen}')
+        out.append(f'nimrod_call_seconds_bucket{{name="{t.name}",le="+Inf"}} {t.count}')
+        out.append(f'nimrod_call_seconds_sum{{name="{t.name}"}} {t.total}')
+        out.append(f'nimrod_call_seconds_count{{name="{t.name}"}} {t.count}')
+
+    out.append('# TYPE nimrod_call_errors_total counter')
+    for t in timers.values():
+        out.append(f'nimrod_call_errors_total{{name="{t.name}"}} {t.errors}')
+    out.append('# TYPE nimrod_calls_in_flight gauge')
+    for t in timers.values():
+        out.append(f'nimrod_calls_in_flight{{name="{t.name}"}} {t.in_flight}')
+
+    out.append('# TYPE nimrod_start_time_seconds gauge')
+    out.append(f'nimrod_start_time_seconds {started}')
+    for name, value in (gauges or {}).items():
+        kind = 'counter' if name.endswith('_total') else 'gauge'
+        out.append(f'# TYPE nimrod_{name} {kind}')
+        out.append(f'nimrod_{name} {value}')
+    return '\n'.join(out) + '\n'
+
+def write_prometheus(path: str, gauges: dict=None):
+    """Write the Prometheus text file, swapping it in whole so a scraper never reads half of it"""
+    text = prometheus(gauges)
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as stream:
+        stream.write(text)
+    os.replace(tmp, path)
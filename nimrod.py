@@ -1,54 +1,215 @@
 import discord
+import argparse
 import asyncio
-import json
+import hashlib
 import os
 import re
 import io
+import json
 import aiohttp
 import datetime
+import time
 import nimroddb
+import attachmenthash
+import downloads
+import outbox
+import metrics
+import nimrodconfig
 from collections import defaultdict
 from discord import app_commands
 from discord.ext import tasks
 from ReportView import ReportView
+from WarningsView import WarningsView
+from aggregator import EventAggregator
+from attachmentstore import AttachmentStore
+from messagestore import MessageStore, StoredMessage
+from raidguard import RaidGuard
+from recorder import EventRecorder
+from spamtracker import SpamTracker
+from spamrules import SpamEngine, Match
+
+def config_path():
+    return os.getenv('NIMROD_CONFIG') or ('config.json' if env == 'prod' else 'config.test.json')
 
-class dotdict(dict):
-    """dot.notation access to dictionary attributes"""
-    __getattr__ = dict.get
-    __setattr__ = dict.__setitem__
-    __delattr__ = dict.__delitem__
+env = os.getenv('NIMROD_ENV')
+with metrics.phase('startup.config'):
+    config = nimrodconfig.load(config_path())
 
-def load_config():
-    global config
-    config_file = 'config.json' if env == 'prod' else 'config.test.json'
-    with open(config_file, encoding='utf8') as stream:
-        config = json.load(stream)
-    config = dotdict(config)
+class GuildState:
+    """One server's settings, the channels they point at and its spam tracking"""
+    __slots__ = ('config', 'targets', 'spam')
 
-env = os.getenv('NIMROD_ENV')
-load_config()
+# state for each of our servers, filled in as they become available
+guilds = {}
+# servers whose stored settings don't fit the config, left out until /settings or a reload fixes them
+bad_guilds = set()
+# /settings overrides by guild id, loaded from the database at startup
+guild_settings = {}
 
-class MyClient(discord.Client):
+class MyClient(discord.AutoShardedClient):
     def __init__(self):
         intents = discord.Intents.default()
         intents.message_content = True
         intents.members = True
-        super().__init__(intents=intents)
+        # edits and deletes are logged from our own message store, so the
+        # library doesn't need to keep whole messages around
+        super().__init__(
+            intents=intents,
+            max_messages=None,
+            shard_count=config.shard_count,
+            shard_ids=sorted(config.shard_ids) if config.shard_ids else None
+        )
         self.synced = False
+        self.force_sync = False
+        self.setup_done = None
+        self.http_session = None
+        self.attachment_store = None
+        self.outbox = outbox.Outbox(max_queue=config.outbox_max_queue)
+        self.recorder = EventRecorder(config.record_events) if config.record_events else None
+
+    async def setup_hook(self):
+        with metrics.phase('startup.setup'):
+            self.http_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=config.http_pool_size),
+                timeout=aiohttp.ClientTimeout(total=60)
+            )
+            # neither depends on the other, and both can be slow on a big install
+            await asyncio.gather(self.open_attachment_store(), self.open_database())
+        self.setup_done = time.perf_counter()
+
+    async def open_attachment_store(self):
+        if not config.attachment_cache_dir:
+            return
+        with metrics.phase('startup.attachment_store'):
+            self.attachment_store = AttachmentStore(
+                config.attachment_cache_dir,
+                max_bytes=config.attachment_cache_bytes,
+                max_age=config.attachment_cache_max_age
+            )
+            await self.attachment_store.open()
+
+    async def open_database(self):
+        with metrics.phase('startup.database'):
+            await nimroddb.connect(
+                config.database,
+                cache_size=config.warn_cache_size,
+                cache_ttl=config.warn_cache_ttl
+            )
+            guild_settings.update(await nimroddb.get_guild_settings() or {})
+
+    async def sync_commands(self):
+        """Sync the slash commands to each of our servers whose commands changed since they were last synced"""
+        with metrics.phase('startup.command_sync'):
+            saved = {} if self.force_sync else await nimroddb.get_command_hashes(self.application_id) or {}
+            changed = [guild_id for guild_id in guilds if saved.get(guild_id) != command_hash(guild_id)]
+            await asyncio.gather(*[sync_guild(guild_id) for guild_id in changed])
+        if changed:
+            print(f'Synced commands to {len(changed)} of {len(guilds)} servers')
+        else:
+            print('Commands unchanged, not synced')
+
+    async def close(self):
+        await events.close()
+        await self.outbox.flush()
+        await super().close()
+        if self.http_session:
+            await self.http_session.close()
+        await message_store.flush()
+        await nimroddb.close()
+        if self.recorder:
+            await asyncio.to_thread(self.recorder.flush)
+
+    def dispatch(self, event, /, *args, **kwargs):
+        if self.recorder:
+            self.recorder.capture(event, args)
+        super().dispatch(event, *args, **kwargs)
+
+    def event(self, coro):
+        # every @bot.event handler is timed for /stats
+        return super().event(metrics.timed(f'event.{coro.__name__}')(coro))
 
     async def on_ready(self):
+        # each server's state was built as it became available, see on_guild_available
         if not self.synced:
-            await tree.sync(guild=discord.Object(id=config.server))
             self.synced = True
-            run_queue.start()
-
-        print(f"{config.env.upper()} Nimrod is ready for duty")
+            if self.setup_done:
+                metrics.timer('startup.gateway').observe(time.perf_counter() - self.setup_done)
+            # handlers are live from here, the sync doesn't need to hold anything up
+            asyncio.create_task(self.sync_commands())
+            events.start()
+            sweep_spam_tracker.start()
+            end_raids.start()
+            if message_store.spill:
+                flush_message_store.start()
+            if self.attachment_store:
+                expire_attachment_store.start()
+            if config.metrics_file:
+                write_metrics.start()
+            if self.recorder:
+                flush_recorder.start()
+            watch_config.start()
+
+        if not metrics.timer('startup.ready').count:
+            metrics.timer('startup.ready').observe(time.time() - metrics.started)
+            print(f'Startup: {startup_report()}')
+        print(f"{config.env.upper()} Nimrod is ready for duty in {len(guilds)} servers")
 
 bot = MyClient()
-tree = app_commands.CommandTree(bot)
 
-queue = {"Member": [], "New Account": []}
-queue_timer = 0
+class MyTree(app_commands.CommandTree):
+    def __init__(self, client: discord.Client):
+        super().__init__(client)
+        # the commands every server we look after gets, for servers added on a reload
+        self.shared = []
+
+    def command(self, **kwargs):
+        # commands go to every server we look after unless told otherwise
+        shared = 'guild' not in kwargs and 'guilds' not in kwargs
+        if shared:
+            kwargs['guilds'] = [discord.Object(id=guild_id) for guild_id in nimrodconfig.servers(config)]
+        decorator = super().command(**kwargs)
+        def wrap(func):
+            command = decorator(metrics.timed(f'command.{kwargs.get("name", func.__name__)}')(func))
+            if shared:
+                self.shared.append(command)
+            return command
+        return wrap
+
+tree = MyTree(bot)
+
+def command_hash(guild_id: int):
+    """Stable hash of the commands registered for a server, as they'd be sent to discord"""
+    commands = [command.to_dict(tree) for command in tree.get_commands(guild=discord.Object(id=guild_id))]
+    commands.sort(key=lambda c: (c.get('type', 1), c['name']))
+    return hashlib.sha256(json.dumps(commands, sort_keys=True).encode('utf8')).hexdigest()
+
+async def sync_guild(guild_id: int):
+    try:
+        await tree.sync(guild=discord.Object(id=guild_id))
+    except Exception as e:
+        print(f'Failed to sync commands to {guild_id}:')
+        print(e)
+        return
+    await nimroddb.set_command_hash(bot.application_id, guild_id, command_hash(guild_id))
+
+async def update_server_commands(added: set, removed: set):
+    """Give servers added to `servers` on a reload their commands, and take them off removed ones"""
+    for guild_id in added:
+        for command in tree.shared:
+            tree.add_command(command, guild=discord.Object(id=guild_id), override=True)
+    for guild_id in removed:
+        tree.clear_commands(guild=discord.Object(id=guild_id))
+    await asyncio.gather(*[sync_guild(guild_id) for guild_id in added | removed])
+
+def startup_report():
+    return ', '.join(f'{t.name[len("startup."):]} {metrics.format_seconds(t.total)}' for t in metrics.timers.values() if t.name.startswith('startup.'))
+
+metrics.instrument(nimroddb, [
+    'add_warn', 'del_warn', 'count_warns', 'list_warns', 'search_warns', 'count_search', 'mod_stats', 'repeat_offenders',
+    'get_guild_settings', 'set_guild_setting', 'get_command_hashes', 'set_command_hash',
+    'store_messages', 'get_stored_message', 'get_stored_messages', 'delete_stored_messages',
+], 'db')
+
 
 def get_member_image(member):
     try:
@@ -99,87 +260,446 @@ def make_embed(color, member, description='', **kwargs):
 
     return embed
 
+AGGREGATE_TITLES = {
+    'role_added': ('blue', '### {} Role Added'),
+    'role_removed': ('blurple', '### {} Role Removed'),
+    'nickname': ('blue', '### Nickname Changes'),
+    'avatar': ('blue', '### Server Avatar Updates'),
+    'join': ('green', '### Joins During Raid'),
+}
+
+async def flush_events(channel_id: int, kind, guild, lines: list):
+    if isinstance(kind, tuple):
+        kind, role_name = kind
+    else:
+        role_name = None
+    color, title = AGGREGATE_TITLES[kind]
+    title = title.format(role_name) + '\n'
+
+    embed = make_embed(color, guild, title)
+    for line in lines:
+        if len(embed.description) + len(line) + 1 > 4096:
+            bot.outbox.send(channel_id, embed=embed)
+            embed = make_embed(color, guild, title)
+        embed.description += f'\n{line}'
+    bot.outbox.send(channel_id, embed=embed)
+
+events = EventAggregator(
+    flush_events,
+    debounce=config.aggregate_debounce,
+    max_latency=config.aggregate_max_latency
+)
+
+raid_guard = RaidGuard(config.raid_join_threshold, config.raid_join_window, config.raid_cooldown)
+
+message_store = MessageStore(config.message_store_bytes, spill=config.message_spill)
+
+THREAD_TYPES = frozenset([discord.ChannelType.public_thread, discord.ChannelType.private_thread])
+
+def is_logged_channel(channel, cfg: nimrodconfig.Config):
+    no_log = cfg.no_log_channels
+    if channel.id in no_log:
+        return False
+    if channel.type in THREAD_TYPES and channel.parent_id in no_log:
+        return False
+    return True
+
+def guild_state(base: nimrodconfig.Config, guild: discord.Guild, overrides: dict, previous: GuildState=None):
+    """Build a server's state from `base` and its `overrides`, keeping its spam tracking from `previous`"""
+    state = GuildState()
+    state.config = nimrodconfig.confine(nimrodconfig.for_guild(base, guild.id, overrides), guild)
+    state.targets = nimrodconfig.resolve(state.config, guild)
+    tracker = previous.spam.tracker if previous else SpamTracker()
+    state.spam = SpamEngine.from_config(state.config.spam_rules, tracker)
+    return state
+
+def load_guild(guild: discord.Guild):
+    """Build and start using the state of one of our servers, or None if it isn't one or its settings are bad"""
+    if guild.id not in nimrodconfig.servers(config):
+        return None
+    try:
+        state = guild_state(config, guild, guild_settings.get(guild.id, {}), guilds.get(guild.id))
+    except ValueError as e:
+        bad_guilds.add(guild.id)
+        print(f'Bad settings for server {guild.id}:')
+        print(e)
+        return None
+    bad_guilds.discard(guild.id)
+    guilds[guild.id] = state
+    update_targets()
+    return state
+
+def state_for(guild_id: int):
+    """
+    One of our servers' state, or None for any other server. Events and
+    commands can come in before a big server's guild_available (it waits
+    on member chunking), so the state is built on first use if need be.
+    """
+    state = guilds.get(guild_id)
+    if state is None and guild_id not in bad_guilds:
+        guild = bot.get_guild(guild_id)
+        if guild is not None:
+            state = load_guild(guild)
+    return state
+
+def settings(guild_id: int):
+    """The config as one of our servers sees it, or None for any other server"""
+    state = state_for(guild_id)
+    return state.config if state else None
+
+def update_targets():
+    bot.outbox.targets = {channel_id: channel for state in guilds.values() for channel_id, channel in state.targets.channels.items()}
+
+def apply_config(new: nimrodconfig.Config):
+    """Switch everything over to `new` in one go, or raise and leave the old config in place"""
+    global config, guilds
+    new_guilds = {}
+    for guild_id in nimrodconfig.servers(new):
+        guild = bot.get_guild(guild_id)
+        if guild is None:
+            continue
+        try:
+            new_guilds[guild_id] = guild_state(new, guild, guild_settings.get(guild_id, {}), guilds.get(guild_id))
+        except ValueError as e:
+            raise ValueError(f'Settings for server {guild_id}:\n{e}')
+
+    old_servers = nimrodconfig.servers(config)
+    config, guilds = new, new_guilds
+    bad_guilds.clear()
+    raid_guard.threshold = new.raid_join_threshold
+    raid_guard.window = new.raid_join_window
+    raid_guard.cooldown = new.raid_cooldown
+    events.debounce = new.aggregate_debounce
+    events.max_latency = new.aggregate_max_latency
+    update_targets()
+    added, removed = nimrodconfig.servers(new) - old_servers, old_servers - nimrodconfig.servers(new)
+    if added or removed:
+        asyncio.create_task(update_server_commands(added, removed))
+
+def reload_config():
+    """Load and apply the config file, returning None or what was wrong with it"""
+    try:
+        apply_config(nimrodconfig.load(config_path()))
+    except Exception as e:
+        # anything else would leave /reload_config unanswered and stop watch_config
+        return str(e)
+    return None
+
+async def open_cached_attachment(attachment):
+    """A discord.File of our own copy of `attachment`, if we have one"""
+    if not bot.attachment_store:
+        return None
+    path = await bot.attachment_store.get(attachment.id)
+    if not path:
+        return None
+    try:
+        return discord.File(path, attachment.filename)
+    except OSError:
+        return None
+
 ######
 ### Commands
 ######
 @tree.command(name='reload_config', description='Reload the bot config', guild=discord.Object(id=config.server))
 async def reload_config_command(interaction):
-    load_config()
+    error = reload_config()
+    if error:
+        await interaction.response.send_message(f'Config not reloaded, still using the old one:\n```\n{error}\n```', ephemeral=True)
+        return
     await interaction.response.send_message('Reloaded', ephemeral=True)
 
-@tree.command(name='warn', description='Warn a user', guild=discord.Object(id=config.server))
+def metric_gauges():
+    stats = bot.outbox.stats()
+    cache = nimroddb.warn_cache.stats()
+    return {
+        'outbox_sent_total': stats['sent'],
+        'outbox_requests_total': stats['requests'],
+        'outbox_dropped_total': stats['dropped'],
+        'outbox_queued': sum(stats['queued'].values()),
+        'message_store_messages': len(message_store),
+        'message_store_bytes': message_store.bytes,
+        'servers': len(guilds),
+        'spam_tracked_users': sum(len(state.spam.tracker.users) for state in guilds.values()),
+        'warn_cache_entries': cache['size'],
+        'warn_cache_hits_total': cache['hits'],
+        'warn_cache_misses_total': cache['misses'],
+        'warn_cache_evictions_total': cache['evictions'],
+        'warn_cache_expirations_total': cache['expirations'],
+    }
+
+@tree.command(name='stats', description='Show handler timings and counters', guild=discord.Object(id=config.server))
+async def stats_command(interaction):
+    description = f'Up since <t:{round(metrics.started)}:R>\n\n'
+    for line in metrics.summary():
+        if len(description) + len(line) + 1 > 4000:
+            break
+        description += f'{line}\n'
+    embed = make_embed('blurple', interaction.guild, description, title='Stats')
+    embed.add_field(name='Gauges', value='\n'.join(f'{name}: {value}' for name, value in metric_gauges().items()), inline=False)
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@tree.command(name='settings', description="Show or change this server's settings")
+@app_commands.default_permissions(manage_guild=True)
+async def settings_command(interaction: discord.Interaction, key: str=None, value: str=None):
+    guild = interaction.guild
+    overrides = dict(guild_settings.get(guild.id, {}))
+    if key is None:
+        lines = [f'**{name}**: `{json.dumps(setting)}`' for name, setting in sorted(overrides.items())]
+        await interaction.response.send_message('\n'.join(lines) or '_Nothing set, using the config file_', ephemeral=True)
+        return
+
+    # values are JSON, anything that doesn't parse is taken as a string
+    setting = None
+    if value is not None:
+        try:
+            setting = json.loads(value)
+        except ValueError:
+            setting = value
+    if setting is None:
+        overrides.pop(key, None)
+    else:
+        overrides[key] = setting
+
+    try:
+        if key in nimrodconfig.LOCAL_KEYS and nimrodconfig.foreign_ids(nimrodconfig.for_guild(config, guild.id, overrides), guild, [key]):
+            raise ValueError(f'{key} must be in this server')
+        state = guild_state(config, guild, overrides, guilds.get(guild.id))
+    except ValueError as e:
+        await interaction.response.send_message(f'Not changed:\n```\n{e}\n```', ephemeral=True)
+        return
+    if not await nimroddb.set_guild_setting(guild.id, key, setting):
+        await interaction.response.send_message("I had a database error and the setting wasn't saved, I'm so sorry, please try again", ephemeral=True)
+        return
+
+    guild_settings[guild.id] = overrides
+    guilds[guild.id] = state
+    bad_guilds.discard(guild.id)
+    update_targets()
+    await interaction.response.send_message(f'{key} {"reset" if setting is None else "set"}', ephemeral=True)
+
+async def server_state(interaction: discord.Interaction):
+    """The state of the server a command was run in, or None after telling whoever ran it why there isn't one"""
+    state = state_for(interaction.guild.id)
+    if state is None:
+        await interaction.response.send_message("This server's settings couldn't be loaded, so I can't do that here. Someone with Manage Server can fix them with /settings", ephemeral=True)
+    return state
+
+@tree.command(name='warn', description='Warn a user')
 async def warn(interaction: discord.Interaction, user: discord.User, reason: str):
+    state = await server_state(interaction)
+    if state is None:
+        return
     await interaction.response.defer()
+    server = interaction.guild
+
+    userDM = make_embed('yellow', server, f'### You have been warned on the {server.name} Discord')
+    userDM.add_field(name='Warning', value=reason, inline=False)
+    try:
+        await user.send(embed=userDM)
+        dm_sent = True
+    except:
+        dm_sent = False
+
+    response = make_embed('yellow', user, f'{user.mention} warned')
+    response.add_field(name='reason', value=reason, inline=False)
+    if not dm_sent:
+        response.description += '\n\n_Could not DM user_'
+    outgoing = await interaction.followup.send(embed=response)
+
     now = datetime.datetime.now()
-    warn_id = await nimroddb.add_warn(interaction.guild.id, user.id, interaction.user.id, int(round(now.timestamp())), reason)
-    if warn_id != False:
-        server = interaction.guild
+    warn_id = await nimroddb.add_warn(server.id, user.id, interaction.user.id, int(round(now.timestamp())), reason, outgoing.channel.id, outgoing.id)
+    if warn_id == False:
+        # the user has been told already, so a retry would warn them twice
+        response.description += "\n\n_I had a database error and this warning wasn't recorded, I'm so sorry_"
+        await outgoing.edit(embed=response)
+        return
 
-        userDM = make_embed('yellow', server, f'### You have been warned on the {server.name} Discord')
-        userDM.add_field(name='Warning', value=reason, inline=False)
-        try:
-            await user.send(embed=userDM)
-            dm_sent = True
-        except:
-            dm_sent = False
-
-        response = make_embed('yellow', user, f'{user.mention} warned')
-        response.add_field(name='reason', value=reason, inline=False)
-        if not dm_sent:
-            response.description += '\n\n_Could not DM user_'
-        outgoing = await interaction.followup.send(embed=response)
-
-        await nimroddb.add_warn_message_id(warn_id, outgoing.channel.id, outgoing.id)
-
-        # log
-        log_embed = make_embed('red', user, f'<@{user.id}> has been warned by <@{interaction.user.id}>')
-        log_embed.add_field(name='reason', value=reason, inline=False)
-        log_channel = bot.get_channel(config.mod_logs_channel)
-        await log_channel.send(embed=log_embed)
-    else:
-        await interaction.followup.send("I had a database error, I'm so sorry, please try again")
+    # log
+    log_embed = make_embed('red', user, f'<@{user.id}> has been warned by <@{interaction.user.id}>')
+    log_embed.add_field(name='reason', value=reason, inline=False)
+    bot.outbox.send(state.config.mod_logs_channel, embed=log_embed, priority=outbox.HIGH)
 
-@tree.command(name='warnings', description='Look up the warnings for a user', guild=discord.Object(id=config.server))
+@tree.command(name='warnings', description='Look up the warnings for a user')
 async def warnings(interaction: discord.Interaction, user: discord.User):
+    state = await server_state(interaction)
+    if state is None:
+        return
     await interaction.response.defer()
-    warnings = await nimroddb.list_warns(user.id)
-    count = len(warnings)
-    description = f'Warnings for {user.mention} ({count}):\n'
-    for w in warnings:
-        w = dotdict(w)
-        if w.message_id:
-            link = f'https://discord.com/channels/{config.server}/{w.channel_id}/{w.message_id}'
-            description += f'\n**ID: [{w.id}]({link}) | Moderator: <@{w.moderator_id}>**'
+    server_id = interaction.guild.id
+    count = await nimroddb.count_warns(server_id, user.id)
+    if count is False:
+        await interaction.followup.send("I had a database error, I'm so sorry, please try again")
+        return
+
+    def render(w):
+        if w['message_id']:
+            link = f'https://discord.com/channels/{server_id}/{w["channel_id"]}/{w["message_id"]}'
+            entry = f'\n**ID: [{w["id"]}]({link}) | Moderator: <@{w["moderator_id"]}>**'
+        else:
+            entry = f'\n**ID: {w["id"]} | Moderator: <@{w["moderator_id"]}>**'
+        return entry + f'\n{w["reason"]} - <t:{w["datestamp"]}:f>\n'
+
+    async def fetch_page(cursor, limit):
+        return await nimroddb.list_warns(server_id, user.id, before=cursor, limit=limit)
+
+    view = WarningsView(
+        embed=make_embed('yellow', user),
+        header=f'Warnings for {user.mention} ({count})',
+        fetch_page=fetch_page,
+        render=render,
+        cursor_for=lambda w: (w['datestamp'], w['id']),
+        page_size=state.config.warnings_page_size
+    )
+    if not await view.load():
+        await interaction.followup.send("I had a database error, I'm so sorry, please try again")
+        return
+    view.message = await interaction.followup.send(embed=view.embed, view=view)
+
+def parse_day(day: str):
+    """Midnight UTC at the start of a YYYY-MM-DD date, as a timestamp"""
+    date = datetime.date.fromisoformat(day)
+    return int(datetime.datetime(date.year, date.month, date.day, tzinfo=datetime.timezone.utc).timestamp())
+
+@tree.command(name='warnsearch', description='Search warning reasons across the server')
+@app_commands.describe(
+    query='Words the reason has to contain, end a word with * to match the start of it',
+    since='First day to include, as YYYY-MM-DD',
+    until='Last day to include, as YYYY-MM-DD'
+)
+@app_commands.choices(action=[app_commands.Choice(name=label, value=value) for value, label in nimroddb.ACTION_TYPES.items()])
+async def warnsearch(interaction: discord.Interaction, query: str=None, moderator: discord.User=None, action: str=None, since: str=None, until: str=None):
+    try:
+        start = parse_day(since) if since else None
+        end = parse_day(until) + 86400 if until else None
+    except ValueError:
+        await interaction.response.send_message('Dates have to look like 2024-01-31', ephemeral=True)
+        return
+    if query is not None and not nimroddb.match_query(query):
+        query = None
+
+    state = await server_state(interaction)
+    if state is None:
+        return
+    await interaction.response.defer()
+    server_id = interaction.guild.id
+    filters = dict(text=query, moderator_id=moderator.id if moderator else None, action_type=action, since=start, until=end)
+    count = await nimroddb.count_search(server_id, **filters)
+    if count is False:
+        await interaction.followup.send("I had a database error, I'm so sorry, please try again")
+        return
+
+    def render(w):
+        label = nimroddb.ACTION_TYPES.get(w['action_type'], w['action_type'])
+        if w['message_id']:
+            link = f'https://discord.com/channels/{server_id}/{w["channel_id"]}/{w["message_id"]}'
+            entry = f'\n**[{label}]({link}) for <@{w["user_id"]}> | Moderator: <@{w["moderator_id"]}>**'
         else:
-            description += f'\n**ID: {w.id} | Moderator: <@{w.moderator_id}>**'
-        description += f'\n{w.reason} - <t:{w.datestamp}:f>\n'
+            entry = f'\n**{label} for <@{w["user_id"]}> | Moderator: <@{w["moderator_id"]}>**'
+        return entry + f'\n{w["reason"]} - <t:{w["datestamp"]}:f>\n'
+
+    async def fetch_page(cursor, limit):
+        return await nimroddb.search_warns(server_id, **filters, after=cursor, limit=limit)
+
+    searched = [f'"{query}"'] if query else []
+    if moderator:
+        searched.append(f'by {moderator.mention}')
+    if action:
+        searched.append(nimroddb.ACTION_TYPES[action].lower() + 's')
+    if since or until:
+        searched.append(f'from {since or "the start"} to {until or "today"}')
+    view = WarningsView(
+        embed=make_embed('yellow', interaction.guild),
+        header=f'{count} results for {", ".join(searched) or "everything"}',
+        fetch_page=fetch_page,
+        render=render,
+        cursor_for=lambda w: (w['score'], w['position']),
+        page_size=state.config.warnings_page_size
+    )
+    if not await view.load():
+        await interaction.followup.send("I had a database error, I'm so sorry, please try again")
+        return
+    view.message = await interaction.followup.send(embed=view.embed, view=view)
+
+# /modstats periods, in days counting today
+MODSTATS_PERIODS = {'today': 1, 'week': 7, 'month': 30}
+
+def field_lines(lines: list, limit: int=1024):
+    """As many of `lines` as fit in an embed field"""
+    value = ''
+    for line in lines:
+        if len(value) + len(line) + 1 > limit:
+            break
+        value += f'{line}\n'
+    return value
+
+@tree.command(name='modstats', description='Moderator actions and repeat offenders')
+@app_commands.choices(period=[
+    app_commands.Choice(name='Today', value='today'),
+    app_commands.Choice(name='Last 7 days', value='week'),
+    app_commands.Choice(name='Last 30 days', value='month'),
+])
+async def modstats(interaction: discord.Interaction, period: str='week'):
+    await interaction.response.defer()
+    server_id = interaction.guild.id
+    days = MODSTATS_PERIODS[period]
+    since = int(time.time()) // 86400 - days + 1
+    stats = await nimroddb.mod_stats(server_id, since)
+    offenders = await nimroddb.repeat_offenders(server_id, since)
+    if stats is False or offenders is False:
+        await interaction.followup.send("I had a database error, I'm so sorry, please try again")
+        return
+
+    totals = defaultdict(int)
+    by_moderator = defaultdict(dict)
+    for moderator_id, action_type, count in stats:
+        totals[action_type] += count
+        by_moderator[moderator_id][action_type] = count
+
+    def describe(counts):
+        return ', '.join(f'{nimroddb.ACTION_TYPES.get(action_type, action_type)} {count}' for action_type, count in sorted(counts.items(), key=lambda c: -c[1]))
 
-    warnings_embed = make_embed('yellow', user, description)
-    await interaction.followup.send(embed=warnings_embed)
+    description = f'### Moderation {"today" if days == 1 else f"over the last {days} days"}\n'
+    if totals:
+        description += f'**{sum(totals.values())}** actions: {describe(totals)}'
+    else:
+        description += '_Nothing logged_'
+    embed = make_embed('blurple', interaction.guild, description)
+
+    moderators = sorted(by_moderator.items(), key=lambda m: -sum(m[1].values()))
+    if moderators:
+        embed.add_field(name='Moderators', value=field_lines([f'<@{moderator_id}> **{sum(counts.values())}**: {describe(counts)}' for moderator_id, counts in moderators]), inline=False)
+    if offenders:
+        embed.add_field(name='Repeat offenders', value=field_lines([f'<@{user_id}> **{count}**' for user_id, count in offenders]), inline=False)
+    await interaction.followup.send(embed=embed)
 
-@tree.command(name='delwarn', description='Delete a warning for a user', guild=discord.Object(id=config.server))
+@tree.command(name='delwarn', description='Delete a warning for a user')
 async def delwarn(interaction: discord.Interaction, warn_id: str):
     await interaction.response.defer()
-    if await nimroddb.del_warn(warn_id):
+    deleted = await nimroddb.del_warn(interaction.guild.id, warn_id)
+    if deleted:
         await interaction.followup.send(embed=discord.Embed(timestamp=datetime.datetime.now(), description=f'{warn_id} deleted'))
+    elif deleted is None:
+        await interaction.followup.send(f'There is no warning {warn_id} on this server')
     else:
         await interaction.followup.send("Something went wrong")
 
-@tree.command(name='flag', description='Flag a user as suspicious', guild=discord.Object(id=config.server))
+@tree.command(name='flag', description='Flag a user as suspicious')
 async def flag(interaction: discord.Interaction, user: discord.User, reason: str):
     await interaction.response.defer()
     now = datetime.datetime.now()
     reason = f'(FLAG) {reason}'
-    warn_id = await nimroddb.add_warn(interaction.guild.id, user.id, interaction.user.id, int(round(now.timestamp())), reason)
-    if warn_id != False:
-        embed = make_embed('yellow', user, f'{user.mention} flagged for: {reason}')
-        outgoing = await interaction.followup.send(embed=embed)
-        await nimroddb.add_warn_message_id(warn_id, outgoing.channel.id, outgoing.id)
-    else:
-        await interaction.followup.send(content='I had a database error, I\'m so sorry, please try again')
-
-@tree.command(name='mute', description='Timeout a user', guild=discord.Object(id=config.server))
+    embed = make_embed('yellow', user, f'{user.mention} flagged for: {reason}')
+    outgoing = await interaction.followup.send(embed=embed)
+    warn_id = await nimroddb.add_warn(interaction.guild.id, user.id, interaction.user.id, int(round(now.timestamp())), reason, outgoing.channel.id, outgoing.id, action_type='flag')
+    if warn_id == False:
+        embed.description += "\n\n_I had a database error and this flag wasn't recorded, I'm so sorry_"
+        await outgoing.edit(embed=embed)
+
+@tree.command(name='mute', description='Timeout a user')
 async def mute(interaction: discord.Interaction, user: discord.User, time: str, reason: str):
+    state = await server_state(interaction)
+    if state is None:
+        return
     await interaction.response.defer()
 
     server = interaction.guild
@@ -232,18 +752,18 @@ async def mute(interaction: discord.Interaction, user: discord.User, time: str,
     # log
     log_embed = make_embed('red', user, f'<@{user.id}> has been timed out for {time} by <@{interaction.user.id}>')
     log_embed.add_field(name='reason', value=reason, inline=False)
-    log_channel = bot.get_channel(config.mod_logs_channel)
-    await log_channel.send(embed=log_embed)
+    bot.outbox.send(state.config.mod_logs_channel, embed=log_embed, priority=outbox.HIGH)
 
     now = datetime.datetime.now()
-    try:
-        warn_id = await nimroddb.add_warn(config.server, user.id, interaction.user.id, int(round(now.timestamp())), f'(MUTE) {reason}')
-        await nimroddb.add_warn_message_id(warn_id, outgoing.channel.id, outgoing.id)
-    except:
+    warn_id = await nimroddb.add_warn(server.id, user.id, interaction.user.id, int(round(now.timestamp())), f'(MUTE) {reason}', outgoing.channel.id, outgoing.id, action_type='mute')
+    if warn_id == False:
         await interaction.channel.send('Error logging mute to warns')
 
-@tree.command(name='ban', description='Ban a user', guild=discord.Object(id=config.server))
+@tree.command(name='ban', description='Ban a user')
 async def ban(interaction: discord.Interaction, user: discord.User, reason: str, delete_message_days: int=0):
+    state = await server_state(interaction)
+    if state is None:
+        return
     await interaction.response.defer()
 
     server = interaction.guild
@@ -268,18 +788,18 @@ async def ban(interaction: discord.Interaction, user: discord.User, reason: str,
     # log
     log_embed = make_embed('red', user, f'<@{user.id}> has been banned by <@{interaction.user.id}>')
     log_embed.add_field(name='reason', value=reason, inline=False)
-    log_channel = bot.get_channel(config.mod_logs_channel)
-    await log_channel.send(embed=log_embed)
+    bot.outbox.send(state.config.mod_logs_channel, embed=log_embed, priority=outbox.HIGH)
 
     now = datetime.datetime.now()
-    try:
-        warn_id = await nimroddb.add_warn(config.server, user.id, interaction.user.id, int(round(now.timestamp())), f'(BAN) {reason}')
-        await nimroddb.add_warn_message_id(warn_id, outgoing.channel.id, outgoing.id)
-    except:
+    warn_id = await nimroddb.add_warn(server.id, user.id, interaction.user.id, int(round(now.timestamp())), f'(BAN) {reason}', outgoing.channel.id, outgoing.id, action_type='ban')
+    if warn_id == False:
         await interaction.channel.send('Error logging ban to warns')
 
-@tree.command(name='spam_ban', description='Ban a compromised account', guild=discord.Object(id=config.server))
+@tree.command(name='spam_ban', description='Ban a compromised account')
 async def spam_ban(interaction: discord.Interaction, user: discord.User):
+    state = await server_state(interaction)
+    if state is None:
+        return
     await interaction.response.defer()
 
     server = interaction.guild
@@ -304,22 +824,22 @@ async def spam_ban(interaction: discord.Interaction, user: discord.User):
     # log
     log_embed = make_embed('red', user, f'<@{user.id}> has been banned by <@{interaction.user.id}>')
     log_embed.add_field(name='reason', value='Compromised Account', inline=False)
-    log_channel = bot.get_channel(config.mod_logs_channel)
-    await log_channel.send(embed=log_embed)
+    bot.outbox.send(state.config.mod_logs_channel, embed=log_embed, priority=outbox.HIGH)
 
     now = datetime.datetime.now()
-    try:
-        warn_id = await nimroddb.add_warn(config.server, user.id, interaction.user.id, int(round(now.timestamp())), f'(BAN) {reason}')
-        await nimroddb.add_warn_message_id(warn_id, outgoing.channel.id, outgoing.id)
-    except:
+    warn_id = await nimroddb.add_warn(server.id, user.id, interaction.user.id, int(round(now.timestamp())), f'(BAN) {reason}', outgoing.channel.id, outgoing.id, action_type='ban')
+    if warn_id == False:
         await interaction.channel.send('Error logging ban to warns')
 
-@tree.command(name='forum_ban', description='Restrict a member from posting to the forums', guild=discord.Object(id=config.server))
+@tree.command(name='forum_ban', description='Restrict a member from posting to the forums')
 async def forum_ban(interaction: discord.Interaction, user: discord.User, reason: str):
+    state = await server_state(interaction)
+    if state is None:
+        return
     await interaction.response.defer()
 
-    for forum in config.forum_ban_channels:
-        forum_chan = bot.get_channel(forum)
+    server = interaction.guild
+    for forum_chan in state.targets.forum_ban_channels:
         overwrites = forum_chan.overwrites
         overwrites[user] = discord.PermissionOverwrite(view_channel=False, add_reactions=False, send_messages=False, send_messages_in_threads=False)
         await forum_chan.edit(overwrites=overwrites)
@@ -331,16 +851,13 @@ async def forum_ban(interaction: discord.Interaction, user: discord.User, reason
     # log
     log_embed = make_embed('red', user, f'<@{user.id}> has been forum banned by <@{interaction.user.id}>')
     log_embed.add_field(name='reason', value=reason, inline=False)
-    log_channel = bot.get_channel(config.mod_logs_channel)
-    await log_channel.send(embed=log_embed)
+    bot.outbox.send(state.config.mod_logs_channel, embed=log_embed, priority=outbox.HIGH)
 
-    try:
-        now = datetime.datetime.now()
-        await nimroddb.add_warn(config.server, user.id, interaction.user.id, int(round(now.timestamp())), f'(FORUM BAN) {reason}')
-    except:
+    now = datetime.datetime.now()
+    if await nimroddb.add_warn(server.id, user.id, interaction.user.id, int(round(now.timestamp())), f'(FORUM BAN) {reason}', action_type='forum_ban') == False:
         await interaction.channel.send('Error logging ban to warns')
 
-@tree.command(name='appeal', description='Log a Ban Appeal', guild=discord.Object(id=config.server))
+@tree.command(name='appeal', description='Log a Ban Appeal')
 async def appeal_command(interaction: discord.Interaction, user: str, decision: str, notes: str=''):
     embed = make_embed('blue', interaction.user, f'### Ban appeal for __{user}__')
     embed.add_field(name='Decision', value=decision, inline=False)
@@ -350,47 +867,65 @@ async def appeal_command(interaction: discord.Interaction, user: str, decision:
 ######
 ### Events
 ######
-# scam spam prevention
-spam_tracker = defaultdict(list)
-currently_flagged_users = set()
-
-async def clean_expired_signatures(user_id: int):
-    await asyncio.sleep(config.spam_time_window)
-    if user_id in currently_flagged_users:
+async def clean_channel(guild: discord.Guild, channel_id: int, message_ids: list, semaphore: asyncio.Semaphore):
+    channel = guild.get_channel_or_thread(channel_id)
+    if not channel:
         return
 
-    if user_id in spam_tracker:
-        now = datetime.datetime.now(datetime.timezone.utc)
-        valid_start = now - datetime.timedelta(seconds=config.spam_time_window)
-
-        spam_tracker[user_id] = [
-            item for item in spam_tracker[user_id] if item[1] > valid_start
-        ]
-
-        if not spam_tracker[user_id]:
-            del spam_tracker[user_id]
-
-async def flag_and_mute(user_id: int, guild: discord.Guild, target_signature: str):
-    await asyncio.sleep(2)
+    async with semaphore:
+        messages = [discord.Object(id=message_id) for message_id in message_ids]
+        # bulk delete takes at most 100 at a time
+        for start in range(0, len(messages), 100):
+            chunk = messages[start:start + 100]
+            try:
+                await channel.delete_messages(chunk, reason='Automated Spam Detection')
+                continue
+            except (discord.NotFound, discord.Forbidden):
+                continue
+            except discord.HTTPException:
+                # discord rejects the whole bulk request if any message
+                # is too old for it, so fall back to deleting one by one
+                pass
+            for message in chunk:
+                try:
+                    await channel.get_partial_message(message.id).delete()
+                except (discord.NotFound, discord.Forbidden):
+                    pass
+                except Exception as e:
+                    print(f'Could not delete message: {e}')
+
+async def flag_and_mute(user_id: int, guild: discord.Guild, match: Match, images: list, state: GuildState):
+    # stick with the settings this started with even if they're changed meanwhile
+    cfg = state.config
+    await asyncio.sleep(cfg.spam_flag_delay)
+    report = await clean_up_spam(user_id, guild, match, images, state)
+    if report:
+        await follow_up_report(guild, cfg, *report)
+
+@metrics.timed('flag_and_mute')
+async def clean_up_spam(user_id: int, guild: discord.Guild, match: Match, images: list, state: GuildState):
+    """Mute the user, delete what they spammed and post the report, returning (member, embed, message, view) for the report"""
+    cfg, targets, engine = state.config, state.targets, state.spam
+    tracker = engine.tracker
 
     member = guild.get_member(user_id)
     if not member:
-        currently_flagged_users.discard(user_id)
-        spam_tracker.pop(user_id, None)
-        return
+        tracker.flagged.discard(user_id)
+        tracker.pop(user_id)
+        return None
 
-    cached_msgs = spam_tracker.get(user_id, [])
-    messages_to_delete = [
-        msg for sig, _, msg in cached_msgs if sig == target_signature
-    ]
+    messages_to_delete = engine.collect(user_id, match)
 
-    spam_tracker.pop(user_id, None)
-    currently_flagged_users.discard(user_id)
+    tracker.pop(user_id)
+    tracker.flagged.discard(user_id)
 
     preserved_files = []
     if messages_to_delete:
-        sample_msg = messages_to_delete[0]
-        for img in [a for a in sample_msg.attachments if a.width is not None]:
+        for img in images:
+            file = await open_cached_attachment(img)
+            if file:
+                preserved_files.append(file)
+                continue
             try:
                 img_bytes = await img.read()
                 preserved_files.append(
@@ -399,103 +934,144 @@ async def flag_and_mute(user_id: int, guild: discord.Guild, target_signature: st
             except Exception as e:
                 print(f'Failed to preserve attachment byte sequence: {e}')
 
-    try:
-        await member.timeout(
-            datetime.timedelta(minutes=10),
-            reason='Automated Spam Detection'
-        )
-    except discord.Forbidden:
-        print(f'Bot cannot mute {member.name}')
-
-    channels_hit = set()
-    for msg in messages_to_delete:
-        channels_hit.add(msg.channel.mention)
+    async def mute():
         try:
-            await msg.delete()
-        except (discord.NotFound, discord.Forbidden):
-            pass
-        except Exception as e:
-            print(f'Could not delete message: {e}')
+            await member.timeout(
+                datetime.timedelta(minutes=10),
+                reason='Automated Spam Detection'
+            )
+        except discord.Forbidden:
+            print(f'Bot cannot mute {member.name}')
+
+    by_channel = defaultdict(list)
+    for record in messages_to_delete:
+        by_channel[record.channel_id].append(record.message_id)
+    channels_hit = {f'<#{channel_id}>' for channel_id in by_channel}
+
+    cleanup = asyncio.Semaphore(cfg.spam_cleanup_concurrency)
+    started = time.perf_counter()
+    await asyncio.gather(
+        mute(),
+        *[clean_channel(guild, channel_id, message_ids, cleanup) for channel_id, message_ids in by_channel.items()]
+    )
+    clean_time = time.perf_counter() - started
 
-    log_channel = discord.utils.get(guild.text_channels, id=config.report_channel)
-    mod_role = discord.utils.get(guild.roles, id=config.moderator_role)
+    log_channel = targets.report_channel
+    mod_role = targets.moderator_role
 
     report_view = ReportView(timeout=None)
     if log_channel:
         channels_str = ', '.join(channels_hit)
         title = 'Automated Spam Detection'
         description = f'**User**\n{member.mention} ({member.id})\n\n' \
-                    f'**Channels cleaned**:\n{channels_str}\n\n' \
-                    'Attached images were spammed. User is under 10m timeout.'
+                    f'**Channels cleaned**:\n{channels_str}\n' \
+                    f'_{len(messages_to_delete)} messages cleaned in {clean_time:.2f}s_\n\n' \
+                    f'**Rule**\n{match.rule.describe()}\n\n' \
+                    f'{"Attached images were spammed. " if preserved_files else ""}User is under 10m timeout.'
         embed = make_embed('yellow', member, description, title=title)
 
-        report_message = await log_channel.send(content=f'{mod_role.mention if mod_role else ""}', embed=embed, files=preserved_files, view=report_view)
-        await report_view.wait()
-        if report_view.value:
-            u = report_view.buttonpusher
+        report_message = await bot.outbox.send_and_wait(cfg.report_channel, content=f'{mod_role.mention if mod_role else ""}', embed=embed, files=preserved_files, view=report_view)
+        return member, embed, report_message, report_view
+    return None
 
-            userDM = make_embed('red', guild, f'### You have been banned from the {guild.name} Discord')
-            userDM.add_field(name='Reason', value='Your account has been compromised and is sending spam/scam messages. Once you have secured access to your account please feel free to appeal using https://appeal.gg/marvelsnap')
-            try:
-                await member.send(embed=userDM)
-            except Exception:
-                pass
-            await asyncio.sleep(0.5)
-            await guild.ban(member, reason='Compromised account', delete_message_seconds=86400)
+async def follow_up_report(guild: discord.Guild, cfg: nimrodconfig.Config, member: discord.Member, embed: discord.Embed, report_message: discord.Message, report_view: ReportView):
+    """Wait for a moderator to answer a spam report, however long that takes, and act on it"""
+    await report_view.wait()
+    if report_view.value:
+        u = report_view.buttonpusher
 
-            embed.description += f'\n\n✅ Banned by {u.mention} ({u.name})'
-            embed.color = discord.Color.green()
-        elif report_view.value == False:
-            u = report_view.buttonpusher
+        userDM = make_embed('red', guild, f'### You have been banned from the {guild.name} Discord')
+        userDM.add_field(name='Reason', value='Your account has been compromised and is sending spam/scam messages. Once you have secured access to your account please feel free to appeal using https://appeal.gg/marvelsnap')
+        try:
+            await member.send(embed=userDM)
+        except Exception:
+            pass
+        await asyncio.sleep(0.5)
+        await guild.ban(member, reason='Compromised account', delete_message_seconds=86400)
+
+        embed.description += f'\n\n✅ Banned by {u.mention} ({u.name})'
+        embed.color = discord.Color.green()
+    elif report_view.value == False:
+        u = report_view.buttonpusher
+
+        await member.timeout(None)
+        bot.outbox.send(cfg.report_channel, '<@145971157902950401> there was a false positive', priority=outbox.HIGH)
+        embed.description += f'\n\n❌ {u.mention} ({u.name}) marked this a false report'
+        embed.color = discord.Color.red()
+    await report_message.edit(embed=embed, view=report_view)
+
+async def cache_attachments(attachments: list):
+    limit = config.attachment_cache_file_bytes
+    items = [downloads.Download(a.url, a.filename, a.size) for a in attachments]
+    await downloads.download_all(bot.http_session, items, limit, limit * len(items))
+    for attachment, item in zip(attachments, items):
+        if item.status != downloads.OK:
+            continue
+        try:
+            await bot.attachment_store.put(attachment.id, item.fp)
+        except Exception as e:
+            print(f'Failed to cache attachment: {e}')
+        finally:
+            item.fp.close()
 
-            await member.timeout(None)
-            await log_channel.send('<@145971157902950401> there was a false positive')
-            embed.description += f'\n\n❌ {u.mention} ({u.name}) marked this a false report'
-            embed.color = discord.Color.red()
-        await report_message.edit(embed=embed, view=report_view)
+@bot.event
+async def on_guild_available(guild):
+    # also after an outage, when the guild and its channels are new objects
+    load_guild(guild)
 
 @bot.event
-async def on_message(message: discord.Message):
-    if message.author.bot or not message.guild:
+async def on_guild_join(guild):
+    if guild.id in guilds or load_guild(guild) is None:
         return
+    if bot.force_sync or (await nimroddb.get_command_hashes(bot.application_id) or {}).get(guild.id) != command_hash(guild.id):
+        await sync_guild(guild.id)
 
-    valid_images = [a for a in message.attachments if a.width is not None]
-    if len(valid_images) != 4:
+@bot.event
+async def on_message(message: discord.Message):
+    if message.author.bot or not message.guild:
         return
-
-    meta_elements = [f'{img.filename}_{img.size}' for img in valid_images]
-    meta_elements.sort()
-    payload_signature = '|'.join(meta_elements)
-
-    user_id = message.author.id
-    now = datetime.datetime.now(datetime.timezone.utc)
-
-    if user_id in currently_flagged_users:
-        # if already flagged just log
-        spam_tracker[user_id].append((payload_signature, now, message))
+    state = state_for(message.guild.id)
+    if state is None:
         return
+    cfg, spam_engine = state.config, state.spam
 
-    recent_signatures = [item[0] for item in spam_tracker[user_id]]
-    if payload_signature in recent_signatures and len(recent_signatures) > 1:
-        # same 4 images send to at least 3 channels, flag em
-        currently_flagged_users.add(user_id)
-        spam_tracker[user_id].append((payload_signature, now, message))
-
-        asyncio.create_task(flag_and_mute(user_id, message.guild, payload_signature))
-        return
+    logged = is_logged_channel(message.channel, cfg)
+    if logged:
+        message_store.add(StoredMessage.from_message(message))
 
-    spam_tracker[user_id].append((payload_signature, now, message))
-    asyncio.create_task(clean_expired_signatures(user_id))
+    valid_images = [a for a in message.attachments if a.width is not None]
+    if valid_images and bot.attachment_store and logged:
+        asyncio.create_task(cache_attachments(valid_images))
+
+    signature = None
+    if spam_engine.wants_images(len(valid_images)):
+        if cfg.spam_signature_mode in ('exact', 'perceptual'):
+            signature = await attachmenthash.content_signature(valid_images, cfg.spam_signature_mode)
+        if signature is None:
+            meta_elements = [f'{img.filename}_{img.size}' for img in valid_images]
+            meta_elements.sort()
+            signature = '|'.join(meta_elements)
+
+    features = spam_engine.features(message, valid_images, signature)
+    match = spam_engine.check(features)
+    if match:
+        asyncio.create_task(flag_and_mute(message.author.id, message.guild, match, valid_images, state))
 
 @bot.event
 async def on_raw_member_remove(event):
+    cfg = settings(event.guild_id)
+    if cfg is None:
+        return
     member = event.user
     embed = make_embed('red', member, f'<@{member.id}> left.')
-    channel = bot.get_channel(config.user_logs_channel)
-    await channel.send(embed=embed)
+    bot.outbox.send(cfg.user_logs_channel, embed=embed)
 
 @bot.event
 async def on_member_join(member):
+    state = state_for(member.guild.id)
+    if state is None:
+        return
+    cfg = state.config
     created = round(int(member.created_at.timestamp()))
     description = f'''
         <@{member.id}> joined.
@@ -504,97 +1080,239 @@ async def on_member_join(member):
         (Roughly <t:{created}:R>)
     '''.replace(' '*8, '').strip()
 
-    embed = make_embed('green', member, description)
-    channel = bot.get_channel(config.user_logs_channel)
-    await channel.send(embed=embed)
-
-@bot.event
-async def on_message_delete(message, thread=False, bulk=False):
-    if message.channel.id in config.no_log_channels:
+    age = (discord.utils.utcnow() - member.created_at).total_seconds()
+    raid, started = raid_guard.join(member.guild.id, age)
+    if raid is None:
+        embed = make_embed('green', member, description)
+        bot.outbox.send(cfg.user_logs_channel, embed=embed)
         return
-    if message.channel.type in [discord.ChannelType.public_thread, discord.ChannelType.private_thread]:
-        if message.channel.parent.id in config.no_log_channels:
-            return
-    if message.author.bot:
+
+    events.add(cfg.user_logs_channel, 'join', member.guild, f'📥 {get_member_name(member)} {member.mention} created <t:{created}:R>')
+    if started:
+        mod_role = state.targets.moderator_role
+        alert = make_embed('red', member.guild, f'### Raid mode on\n**{raid.joins}** joins in the last {raid_guard.window} seconds\n\n{raid.describe_ages()}')
+        bot.outbox.send(cfg.report_channel, content=mod_role.mention if mod_role else None, embed=alert, priority=outbox.HIGH)
+
+    if cfg.raid_timeout_age and age < cfg.raid_timeout_age:
+        try:
+            await member.timeout(datetime.timedelta(minutes=cfg.raid_timeout_minutes), reason='Raid protection')
+            raid.actioned += 1
+        except Exception as e:
+            print(f'Failed to time out {member.id} during raid:')
+            print(e)
+
+async def log_deleted_message(record: StoredMessage, thread: discord.Thread=None, bulk=False):
+    guild = bot.get_guild(record.guild_id)
+    cfg = settings(record.guild_id)
+    if guild is None or cfg is None:
         return
+    author = guild.get_member(record.author_id) or bot.get_user(record.author_id) or guild
 
-    created = round(int(message.created_at.timestamp()))
     title = 'Message deleted'
     if bulk == True:
         title = 'Messages bulk deleted'
 
-    description = f'in <#{message.channel.id}> by <@{message.author.id}>'
-    if thread == True:
+    description = f'in <#{record.channel_id}> by <@{record.author_id}>'
+    if thread:
         title = 'Thread deleted'
-        description = f'"{message.channel.name}" in <#{message.channel.parent.id}> by <@{message.author.id}>'
-
-    embed = make_embed('red', message.author, description, title=title)
-
-    content = message.content
-    if message.poll:
-        content += '\n**poll**'
-        content += f'\n_Question_: {message.poll["question"]["text"]}'
-        for answer in message.poll['answers']:
-            content += f'\n_Answer_: {answer["poll_media"]["text"]}'
-
-    embed.description += f'\n\n**deleted message**\n{content}'
-    embed.description += f'\n\n**originally posted**\n<t:{created}:f>'
-    embed.description += f'\n\n**message id**\n{message.id}'
+        description = f'"{thread.name}" in <#{thread.parent_id}> by <@{record.author_id}>'
+
+    embed = make_embed('red', author, description, title=title)
+
+    embed.description += f'\n\n**deleted message**\n{record.content}'
+    embed.description += f'\n\n**originally posted**\n<t:{record.created_at}:f>'
+    embed.description += f'\n\n**message id**\n{record.id}'
+
+    if record.reference_id:
+        embed.description += f'\n\n**reply to**\nhttps://discord.com/channels/{record.guild_id}/{record.channel_id}/{record.reference_id}'
+
+    limit = guild.filesize_limit
+    max_file_bytes = min(config.log_attachment_max_bytes or limit, limit)
+    max_total_bytes = min(config.log_message_max_bytes or limit, limit)
+
+    cached = []
+    cached_bytes = 0
+    too_large = []
+    items = []
+    for attachment in record.attachments:
+        file = await open_cached_attachment(attachment)
+        if file:
+            # our own copies count against the same limits as downloads
+            size = os.fstat(file.fp.fileno()).st_size
+            if size <= max_file_bytes and cached_bytes + size <= max_total_bytes:
+                cached.append(file)
+                cached_bytes += size
+            else:
+                file.close()
+                too_large.append((attachment.filename, attachment.url))
+        else:
+            items.append(downloads.Download(attachment.url, attachment.filename, attachment.size))
+    sticker = None
+    if record.sticker:
+        name, url = record.sticker
+        sticker = downloads.Download(url, f'{name}.png')
+        items.append(sticker)
+
+    await downloads.download_all(
+        bot.http_session,
+        items,
+        max_file_bytes=max_file_bytes,
+        max_total_bytes=max_total_bytes - cached_bytes
+    )
 
-    if message.reference:
-        embed.description += f'\n\n**reply to**\nhttps://discord.com/channels/{config.server}/{message.channel.id}/{message.reference.message_id}'
+    files = cached + [discord.File(item.fp, item.filename) for item in items if item.status == downloads.OK]
+    failed = [item for item in items if item.status == downloads.FAILED and item is not sticker]
+    too_large += [(item.filename, item.url) for item in items if item.status == downloads.TOO_LARGE]
 
-    files = []
-    try:
-        for file in message.attachments:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(file.url) as resp:
-                    if resp.status != 200:
-                        raise Exception
-                    data = io.BytesIO(await resp.read())
-                    files.append(discord.File(data, f'{file.filename}'))
-    except Exception:
-        embed.description += f'\n_(There were {len(message.attachments)} images attached but discord is stupid)_'
-
-    if files:
+    if failed:
+        embed.description += f'\n_(There were {len(failed)} images attached but discord is stupid)_'
+    if too_large:
+        links = ', '.join(f'[{filename}]({url})' for filename, url in too_large)
+        embed.description += f'\n_(Too large to reattach: {links})_'
+    if cached or any(item.status == downloads.OK for item in items if item is not sticker):
         embed.description += '\n_(Above images were attached)_'
+    if sticker:
+        if sticker.status == downloads.OK:
+            embed.description += '\n_(Above sticker was attached)_'
+        else:
+            print('Failed to download sticker image')
 
-    if message.stickers:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(message.stickers[0].url) as resp:
-                if resp.status != 200:
-                    print('Failed to download sticker image')
-                data = io.BytesIO(await resp.read())
-                files.append(discord.File(data, f'{message.stickers[0].name}.png'))
-        embed.description += '\n_(Above sticker was attached)_'
+    bot.outbox.send(cfg.message_deletes_channel, embed=embed, files=files)
 
-    channel = bot.get_channel(config.message_deletes_channel)
-    await channel.send(embed=embed, files=files)
+@bot.event
+async def on_raw_message_delete(event):
+    record = await message_store.pop(event.message_id)
+    if record:
+        await log_deleted_message(record)
 
 @bot.event
 async def on_thread_delete(thread):
-    try: await on_message_delete(thread.starter_message, thread=True)
+    # a thread's starter message has the same id as the thread
+    try:
+        record = await message_store.pop(thread.id)
+        if record:
+            await log_deleted_message(record, thread=thread)
     except Exception as e:
         print('Failed to log thread deletion')
         print(e)
 
 @bot.event
-async def on_bulk_message_delete(messages):
-    for message in messages:
-        await on_message_delete(message, bulk=True)
+async def on_raw_bulk_message_delete(event):
+    records = [r for r in await message_store.pop_many(list(event.message_ids)) if r is not None]
+    if len(records) < 2:
+        for record in records:
+            await log_deleted_message(record, bulk=True)
+        return
+
+    guild = bot.get_guild(event.guild_id)
+    cfg = settings(event.guild_id)
+    if guild is None or cfg is None:
+        return
+
+    # one transcript and one zip of attachments instead of an embed (and
+    # its downloads) per message
+    records.sort(key=lambda r: r.id)
+    channel_id = event.channel_id
+    authors = {}
+    lines = []
+    limit = guild.filesize_limit
+    max_file_bytes = min(config.log_attachment_max_bytes or limit, limit)
+    cached = []
+    cached_bytes = 0
+    skipped = 0
+    items = []
+    for record in records:
+        authors[record.author_id] = record.author_name
+        posted = datetime.datetime.fromtimestamp(record.created_at, datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S UTC')
+        lines.append(f'[{posted}] {record.author_name} ({record.author_id}) - message {record.id}')
+        if record.reference_id:
+            lines.append(f'  reply to {record.reference_id}')
+        for line in record.content.splitlines():
+            lines.append(f'  {line}')
+        for i, attachment in enumerate(record.attachments):
+            lines.append(f'  attachment: {attachment.filename} ({attachment.url})')
+            # attachments on one message can share a filename
+            name = f'{record.id}_{i}_{attachment.filename}'
+            path = await bot.attachment_store.get(attachment.id) if bot.attachment_store else None
+            fp = None
+            if path:
+                try:
+                    fp = open(path, 'rb')
+                except OSError:
+                    # evicted since it was looked up, download it instead
+                    pass
+            size = os.fstat(fp.fileno()).st_size if fp else None
+            if fp is None:
+                items.append(downloads.Download(attachment.url, name, attachment.size))
+            elif size <= max_file_bytes:
+                cached.append((name, fp))
+                cached_bytes += size
+            else:
+                fp.close()
+                skipped += 1
+        if record.sticker:
+            lines.append(f'  sticker: {record.sticker[0]}')
+        lines.append('')
+    transcript = '\n'.join(lines).encode('utf8')
+
+    budget = limit - len(transcript)
+    await downloads.download_all(
+        bot.http_session,
+        items,
+        max_file_bytes=max_file_bytes,
+        max_total_bytes=budget - cached_bytes
+    )
+    entries = cached + [(item.filename, item.fp) for item in items if item.status == downloads.OK]
+    missing = skipped + len(items) - (len(entries) - len(cached))
+
+    files = [discord.File(io.BytesIO(transcript), f'deleted-{channel_id}.txt')]
+    if entries:
+        bundle = await downloads.zip_files(entries)
+        if os.fstat(bundle.fileno()).st_size <= budget:
+            files.append(discord.File(bundle, f'deleted-{channel_id}-attachments.zip'))
+        else:
+            bundle.close()
+            missing += len(entries)
+            entries = []
+
+    first = records[0].created_at
+    last = records[-1].created_at
+    description = f'{len(records)} messages in <#{channel_id}>'
+    description += f'\n\n**posted between**\n<t:{first}:f> and <t:{last}:f>'
+    if entries:
+        description += f'\n\n_({len(entries)} attachments are in the zip)_'
+    if missing:
+        description += f'\n_({missing} attachments could not be saved, links are in the transcript)_'
+    description += '\n\n**authors**\n'
+    mentions = ' '.join(f'<@{author_id}>' for author_id in authors)
+    if len(description) + len(mentions) > 4096:
+        mentions = f'{len(authors)} users, see the transcript'
+    description += mentions
+
+    embed = make_embed('red', guild, description, title='Messages bulk deleted')
+    bot.outbox.send(cfg.message_deletes_channel, embed=embed, files=files)
 
 @bot.event
-async def on_message_edit(before, after):
-    if after.channel.id in config.no_log_channels:
+async def on_raw_message_edit(event):
+    after = event.message
+    if after.author.bot or not after.guild:
         return
-    if after.channel.type in [discord.ChannelType.public_thread, discord.ChannelType.private_thread]:
-        if after.channel.parent.id in config.no_log_channels:
-            return
-    if after.author.bot:
+    cfg = settings(after.guild.id)
+    if cfg is None or not is_logged_channel(after.channel, cfg):
         return
 
-    if before.content.strip() == after.content.strip():
-        return
+    record = await message_store.get(after.id)
+    message_store.add(StoredMessage.from_message(after))
+    if record is None:
+        # embeds being filled in also come through as edits, real edits
+        # are the only ones with an edit time
+        if after.edited_at is None:
+            return
+        before = '_(not in the message store)_'
+    else:
+        before = record.content
+        if before.strip() == after.content.strip():
+            return
 
     embed = make_embed(
         color='yellow',
@@ -603,18 +1321,23 @@ async def on_message_edit(before, after):
         title='Message edited',
         url=after.jump_url
     )
-    embed.description += f'\n\n**before**\n{before.content}'
+    embed.description += f'\n\n**before**\n{before}'
     embed.description += f'\n\n**after**\n{after.content}'
-    channel = bot.get_channel(config.message_edits_channel)
-    await channel.send(embed=embed)
+    bot.outbox.send(cfg.message_edits_channel, embed=embed)
 
 @bot.event
 async def on_member_update(before, after):
+    cfg = settings(after.guild.id)
+    if cfg is None:
+        return
     title = f'<@{after.id}> has been updated.\n'
     change_embed = make_embed('blue', after, title)
 
     if before.nick != after.nick:
-        change_embed.description += f'\n🕵️‍♂️ changed nickname from **{before.nick}** to **{after.nick}**'
+        if 'nicknames' in cfg.aggregate_events:
+            events.add(cfg.user_logs_channel, 'nickname', after.guild, f'🕵️‍♂️ {after.mention} **{before.nick}** → **{after.nick}**')
+        else:
+            change_embed.description += f'\n🕵️‍♂️ changed nickname from **{before.nick}** to **{after.nick}**'
 
     if before.timed_out_until != after.timed_out_until:
         if before.timed_out_until == None:
@@ -625,11 +1348,13 @@ async def on_member_update(before, after):
             change_embed.description += f'\n⏰ **timeout removed**'
 
     if before.guild_avatar != after.guild_avatar:
-        change_embed.description += f'\n🖼 updated server avatar\n'
+        if 'avatars' in cfg.aggregate_events:
+            events.add(cfg.user_logs_channel, 'avatar', after.guild, f'🖼 {after.mention} updated server avatar')
+        else:
+            change_embed.description += f'\n🖼 updated server avatar\n'
 
     if change_embed.description != title:
-        log_chan = bot.get_channel(config.user_logs_channel)
-        await log_chan.send(embed=change_embed)
+        bot.outbox.send(cfg.user_logs_channel, embed=change_embed)
 
     role_embed = make_embed('blue', after, title)
     b_roles = [r.name for r in before.roles]
@@ -637,41 +1362,45 @@ async def on_member_update(before, after):
     added = [r for r in a_roles if r not in b_roles]
     removed = [r for r in b_roles if r not in a_roles]
 
-    global queue
-    global queue_timer
+    name = f'{get_member_name(after)} {after.mention}'
+    batched = cfg.aggregate_roles
+    for role_name in added:
+        if '*' in batched or role_name in batched:
+            events.add(cfg.role_updates_channel, ('role_added', role_name), after.guild, f'✅ {name}')
+    for role_name in removed:
+        if '*' in batched or role_name in batched:
+            events.add(cfg.role_updates_channel, ('role_removed', role_name), after.guild, f'⛔ {name}')
+    added = [r for r in added if '*' not in batched and r not in batched]
+    removed = [r for r in removed if '*' not in batched and r not in batched]
+
     if added:
-        if len(added) == 1 and added[0] == 'Member':
-            queue['Member'].append(after)
-            queue_timer = 10
-        else:
-            role_embed.description += '\nRoles added:'
-            for role_name in added:
-                role_embed.description += f'\n✅ {role_name}'
+        role_embed.description += '\nRoles added:'
+        for role_name in added:
+            role_embed.description += f'\n✅ {role_name}'
 
     if removed:
-        if len(removed) == 1 and removed[0] == 'New Account':
-            queue['New Account'].append(after)
-            queue_timer = 10
-        else:
-            role_embed.description += '\nRoles removed:'
-            for role_name in removed:
-                role_embed.description += f'\n⛔ {role_name}'
+        role_embed.description += '\nRoles removed:'
+        for role_name in removed:
+            role_embed.description += f'\n⛔ {role_name}'
 
     if role_embed.description != title:
-        log_chan = bot.get_channel(config.role_updates_channel)
-        await log_chan.send(embed=role_embed)
+        bot.outbox.send(cfg.role_updates_channel, embed=role_embed)
 
 @bot.event
 async def on_member_ban(guild, user):
+    cfg = settings(guild.id)
+    if cfg is None:
+        return
     embed = make_embed('red', user, f'{user.mention} has been banned.')
-    chan = bot.get_channel(config.mod_logs_channel)
-    await chan.send(embed=embed)
+    bot.outbox.send(cfg.mod_logs_channel, embed=embed)
 
 @bot.event
 async def on_member_unban(guild, user):
+    cfg = settings(guild.id)
+    if cfg is None:
+        return
     embed = make_embed('green', user, f'{user.mention} has been unbanned.')
-    chan = bot.get_channel(config.mod_logs_channel)
-    await chan.send(embed=embed)
+    bot.outbox.send(cfg.mod_logs_channel, embed=embed)
 
 @bot.event
 async def on_user_update(before, after):
@@ -688,18 +1417,25 @@ async def on_user_update(before, after):
 
 @bot.event
 async def on_guild_channel_create(channel):
-    chan = bot.get_channel(config.server_logs_channel)
+    cfg = settings(channel.guild.id)
+    if cfg is None:
+        return
     embed = make_embed('green', channel.guild, f'Channel created: <#{channel.id}>')
-    await chan.send(embed=embed)
+    bot.outbox.send(cfg.server_logs_channel, embed=embed)
 
 @bot.event
 async def on_guild_channel_delete(channel):
-    chan = bot.get_channel(config.server_logs_channel)
+    cfg = settings(channel.guild.id)
+    if cfg is None:
+        return
     embed = make_embed('red', channel.guild, f'Channel deleted: {channel.name} ({channel.id})')
-    await chan.send(embed=embed)
+    bot.outbox.send(cfg.server_logs_channel, embed=embed)
 
 @bot.event
 async def on_guild_channel_update(before, after):
+    cfg = settings(after.guild.id)
+    if cfg is None:
+        return
     overwrites = {}
     befores = {}
     for role in after.changed_roles:
@@ -734,23 +1470,29 @@ async def on_guild_channel_update(before, after):
         embed.description += f'\n\n### Slowmode updated:\n{before.slowmode_delay} seconds -> {after.slowmode_delay} seconds'
 
     if embed.description.strip() != description:
-        chan = bot.get_channel(config.server_logs_channel)
-        await chan.send(embed=embed)
+        bot.outbox.send(cfg.server_logs_channel, embed=embed)
 
 @bot.event
 async def on_guild_role_create(role):
-    chan = bot.get_channel(config.role_updates_channel)
+    cfg = settings(role.guild.id)
+    if cfg is None:
+        return
     embed = make_embed('green', role.guild, f'Role created: {role.mention}')
-    await chan.send(embed=embed)
+    bot.outbox.send(cfg.role_updates_channel, embed=embed)
 
 @bot.event
 async def on_guild_role_delete(role):
-    chan = bot.get_channel(config.role_updates_channel)
+    cfg = settings(role.guild.id)
+    if cfg is None:
+        return
     embed = make_embed('red', role.guild, f'Role deleted: {role.name} ({role.id})')
-    await chan.send(embed=embed)
+    bot.outbox.send(cfg.role_updates_channel, embed=embed)
 
 @bot.event
 async def on_guild_role_update(before, after):
+    cfg = settings(after.guild.id)
+    if cfg is None:
+        return
     desc = f'**Role updated: {after.mention}**\n'
     embed = make_embed('blurple', after.guild, desc)
     if before.name != after.name:
@@ -780,11 +1522,13 @@ async def on_guild_role_update(before, after):
             embed.description += f'\n{emojis[access]} {p}'
 
     if embed.description != desc:
-        chan = bot.get_channel(config.role_updates_channel)
-        await chan.send(embed=embed)
+        bot.outbox.send(cfg.role_updates_channel, embed=embed)
 
 @bot.event
 async def on_voice_state_update(member, before, after):
+    cfg = settings(member.guild.id)
+    if cfg is None:
+        return
     if before.channel == after.channel:
         return
 
@@ -795,38 +1539,75 @@ async def on_voice_state_update(member, before, after):
     else:
         embed = make_embed('blurple', member, f'{member.mention} switched from <#{before.channel.id}> to <#{after.channel.id}>')
 
-    chan = bot.get_channel(config.voice_logs_channel)
-    await chan.send(embed=embed)
+    bot.outbox.send(cfg.voice_logs_channel, embed=embed)
 
 ### TASKS
+@tasks.loop(minutes=10)
+async def expire_attachment_store():
+    await bot.attachment_store.expire()
+
+@tasks.loop(seconds=1)
+async def sweep_spam_tracker():
+    for state in list(guilds.values()):
+        state.spam.tracker.expire(config.spam_time_window)
+
+@tasks.loop(seconds=30)
+async def flush_message_store():
+    await message_store.flush(max_age=config.message_spill_days * 86400)
+
+config_mtime = None
+
+@tasks.loop(seconds=5)
+async def watch_config():
+    global config_mtime
+    try:
+        mtime = os.stat(config_path()).st_mtime
+    except OSError:
+        return
+    if config_mtime is None or not config.config_watch:
+        config_mtime = mtime
+        return
+    if mtime == config_mtime:
+        return
+    config_mtime = mtime
+    error = reload_config()
+    if error:
+        print(f'Config changed on disk but could not be loaded, still using the old one:\n{error}')
+    else:
+        print('Config changed on disk, reloaded')
+
+@tasks.loop(seconds=5)
+async def flush_recorder():
+    try:
+        await asyncio.to_thread(bot.recorder.flush)
+    except Exception as e:
+        print('Failed to write recorded events:')
+        print(e)
+
+@tasks.loop(seconds=15)
+async def write_metrics():
+    try:
+        await asyncio.to_thread(metrics.write_prometheus, config.metrics_file, metric_gauges())
+    except Exception as e:
+        print('Failed to write metrics:')
+        print(e)
+
 @tasks.loop(seconds=10)
-async def run_queue():
-    global queue
-    global queue_timer
-    if queue_timer > 0:
-        queue_timer = 0
-        return
-    if len(queue) == 0:
-        return
-
-    server = [g for g in bot.guilds if g.id == config.server][0]
-
-    title = '### Member Role Added\n'
-    embed = make_embed('blue', server, title)
-    for member in queue['Member']:
-        embed.description += f'\n✅ {get_member_name(member)} {member.mention}'
-    queue['Member'] = []
-    if embed.description != title:
-        log_chan = bot.get_channel(config.role_updates_channel)
-        await log_chan.send(embed=embed)
-
-    title = '### New Account Role Removed\n'
-    embed = make_embed('blurple', server, title)
-    for member in queue['New Account']:
-        embed.description += f'\n⛔ {get_member_name(member)} {member.mention}'
-    queue['New Account'] = []
-    if embed.description != title:
-        log_chan = bot.get_channel(config.role_updates_channel)
-        await log_chan.send(embed=embed)
-
-bot.run(config.token)
+async def end_raids():
+    for guild_id, raid in raid_guard.expire():
+        guild = bot.get_guild(guild_id)
+        cfg = settings(guild_id)
+        if guild is None or cfg is None:
+            continue
+        minutes = max(1, round((raid.last_join - raid.started) / 60))
+        description = f'### Raid mode off\n**{raid.joins}** joins over about {minutes} minutes\n\n{raid.describe_ages()}'
+        if raid.actioned:
+            description += f'\n\n{raid.actioned} young accounts timed out'
+        bot.outbox.send(cfg.report_channel, embed=make_embed('green', guild, description), priority=outbox.HIGH)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the bot')
+    parser.add_argument('--force-sync', action='store_true', help='sync the slash commands even if they look unchanged')
+    args = parser.parse_args()
+    bot.force_sync = args.force_sync
+    bot.run(config.token)
@@ -0,0 +1,251 @@
+import json
+from spamrules import SpamEngine
+
+REQUIRED = object()
+
+# value kinds beyond the plain python types
+ID = 'id'
+IDS = 'ids'
+NAMES = 'names'
+
+# every config key, what it has to be and its default
+SPEC = {
+    'token': (str, REQUIRED),
+    'env': (str, 'test'),
+    'server': (ID, REQUIRED),
+    'servers': (IDS, frozenset()),
+    'shard_count': (int, None),
+    'shard_ids': (IDS, None),
+    'database': (str, 'nimrod.db'),
+
+    'report_channel': (ID, None),
+    'mod_logs_channel': (ID, None),
+    'user_logs_channel': (ID, None),
+    'role_updates_channel': (ID, None),
+    'server_logs_channel': (ID, None),
+    'message_deletes_channel': (ID, None),
+    'message_edits_channel': (ID, None),
+    'voice_logs_channel': (ID, None),
+    'moderator_role': (ID, None),
+    'no_log_channels': (IDS, frozenset()),
+    'forum_ban_channels': (IDS, frozenset()),
+    'config_watch': (bool, False),
+
+    'warnings_page_size': (int, 10),
+    'warn_cache_size': (int, 512),
+    'warn_cache_ttl': (float, 300),
+
+    'spam_time_window': (float, REQUIRED),
+    'spam_signature_mode': (str, 'metadata'),
+    'spam_rules': (list, None),
+    'spam_flag_delay': (float, 2),
+    'spam_cleanup_concurrency': (int, 5),
+
+    'http_pool_size': (int, 20),
+    'outbox_max_queue': (int, 500),
+    'log_attachment_max_bytes': (int, None),
+    'log_message_max_bytes': (int, None),
+    'attachment_cache_dir': (str, None),
+    'attachment_cache_bytes': (int, 1024**3),
+    'attachment_cache_max_age': (float, 7 * 86400),
+    'attachment_cache_file_bytes': (int, 25 * 1024**2),
+    'message_store_bytes': (int, 32 * 1024**2),
+    'message_spill': (bool, False),
+    'message_spill_days': (float, 7),
+
+    'aggregate_debounce': (float, 10),
+    'aggregate_max_latency': (float, 60),
+    'aggregate_roles': (NAMES, frozenset(['Member', 'New Account'])),
+    'aggregate_events': (NAMES, frozenset()),
+
+    'raid_join_threshold': (int, 10),
+    'raid_join_window': (float, 60),
+    'raid_cooldown': (float, 300),
+    'raid_timeout_age': (float, None),
+    'raid_timeout_minutes': (float, 60),
+
+    'metrics_file': (str, None),
+    'record_events': (str, None),
+}
+
+# keys a server can override for itself with /settings
+GUILD_KEYS = frozenset([
+    'report_channel', 'mod_logs_channel', 'user_logs_channel', 'role_updates_channel', 'server_logs_channel',
+    'message_deletes_channel', 'message_edits_channel', 'voice_logs_channel', 'moderator_role',
+    'no_log_channels', 'forum_ban_channels', 'warnings_page_size',
+    'spam_signature_mode', 'spam_rules', 'spam_flag_delay',
+    'aggregate_roles', 'aggregate_events', 'raid_timeout_age', 'raid_timeout_minutes',
+])
+
+CHANNEL_KEYS = [name for name, (kind, _) in SPEC.items() if kind == ID and name.endswith('_channel')]
+# channel and role ids that only make sense inside the server they're set for
+LOCAL_KEYS = CHANNEL_KEYS + ['moderator_role', 'no_log_channels', 'forum_ban_channels']
+
+class Config:
+    """A checked, read only config. Build it with `compile_config` or `load`"""
+    __slots__ = tuple(SPEC)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('The config is read only, reload it instead')
+
+    def __repr__(self):
+        return f'<Config env={self.env} server={self.server}>'
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def _check(name: str, kind, value):
+    """The value to store for `name`, or raise ValueError"""
+    if kind == ID:
+        if _is_int(value):
+            return value
+        raise ValueError(f'{name} must be an id')
+    if kind == IDS:
+        if isinstance(value, list) and all(_is_int(v) for v in value):
+            return frozenset(value)
+        raise ValueError(f'{name} must be a list of ids')
+    if kind == NAMES:
+        if isinstance(value, list) and all(isinstance(v, str) for v in value):
+            return frozenset(value)
+        raise ValueError(f'{name} must be a list of names')
+    if kind is float:
+        if _is_int(value) or isinstance(value, float):
+            return float(value)
+        raise ValueError(f'{name} must be a number')
+    if kind is int:
+        if _is_int(value):
+            return value
+        raise ValueError(f'{name} must be a whole number')
+    if isinstance(value, kind):
+        return value
+    raise ValueError(f'{name} must be a {kind.__name__}')
+
+def compile_config(raw: dict):
+    """Check a parsed config file and freeze it into a Config, raising ValueError listing every problem"""
+    config = object.__new__(Config)
+    problems = []
+    for name, (kind, default) in SPEC.items():
+        value = raw.get(name)
+        if value is None:
+            if default is REQUIRED:
+                problems.append(f'{name} is required')
+                continue
+            value = default
+        else:
+            try:
+                value = _check(name, kind, value)
+            except ValueError as e:
+                problems.append(str(e))
+                continue
+        object.__setattr__(config, name, value)
+
+    problems += _cross_checks(config)
+    if problems:
+        raise ValueError('\n'.join(problems))
+
+    unknown = set(raw) - set(SPEC)
+    if unknown:
+        print(f'Ignoring unknown config keys: {", ".join(sorted(unknown))}')
+    return config
+
+def _cross_checks(config: Config):
+    problems = []
+    if getattr(config, 'spam_signature_mode', None) not in (None, 'metadata', 'exact', 'perceptual'):
+        problems.append('spam_signature_mode must be metadata, exact or perceptual')
+    if getattr(config, 'shard_ids', None) and not getattr(config, 'shard_count', None):
+        problems.append('shard_ids needs shard_count')
+    if getattr(config, 'spam_rules', None) is not None:
+        # build the rules once, with no tracker, just to see that they can be
+        try:
+            SpamEngine.from_config(config.spam_rules, None)
+        except ValueError as e:
+            problems.append(f'spam_rules: {e}')
+    return problems
+
+def servers(config: Config):
+    """Every server this deployment looks after"""
+    return config.servers | {config.server}
+
+def _copy(config: Config):
+    copy = object.__new__(Config)
+    for name in SPEC:
+        object.__setattr__(copy, name, getattr(config, name))
+    return copy
+
+def for_guild(config: Config, guild_id: int, overrides: dict):
+    """
+    `config` as seen by one server: its /settings `overrides` on top of the
+    file. Channel and role ids in the file belong to the main server, so
+    other servers start without any.
+    """
+    guild_config = _copy(config)
+    object.__setattr__(guild_config, 'server', guild_id)
+    if guild_id != config.server:
+        for name in GUILD_KEYS:
+            kind, default = SPEC[name]
+            if kind in (ID, IDS):
+                object.__setattr__(guild_config, name, default)
+
+    problems = []
+    for name, value in overrides.items():
+        if name not in GUILD_KEYS:
+            problems.append(f'{name} can not be set per server')
+            continue
+        kind, default = SPEC[name]
+        try:
+            object.__setattr__(guild_config, name, default if value is None else _check(name, kind, value))
+        except ValueError as e:
+            problems.append(str(e))
+    problems += _cross_checks(guild_config)
+    if problems:
+        raise ValueError('\n'.join(problems))
+    return guild_config
+
+def load(path: str):
+    with open(path, encoding='utf8') as stream:
+        return compile_config(json.load(stream))
+
+class Resolved:
+    """The channel and role objects the config points at, looked up once per load"""
+    __slots__ = ('channels', 'report_channel', 'moderator_role', 'forum_ban_channels')
+
+def resolve(config: Config, guild):
+    resolved = Resolved()
+    resolved.channels = {}
+    for name in CHANNEL_KEYS:
+        channel_id = getattr(config, name)
+        channel = guild.get_channel(channel_id) if channel_id else None
+        if channel is not None:
+            resolved.channels[channel_id] = channel
+    resolved.report_channel = resolved.channels.get(config.report_channel)
+    resolved.moderator_role = guild.get_role(config.moderator_role) if config.moderator_role else None
+    resolved.forum_ban_channels = [c for c in map(guild.get_channel, config.forum_ban_channels) if c is not None]
+    return resolved
+
+def foreign_ids(config: Config, guild, names=LOCAL_KEYS):
+    """{name: ids} for the settings in `names` that point at channels or roles outside `guild`"""
+    foreign = {}
+    for name in names:
+        find = guild.get_role if name == 'moderator_role' else guild.get_channel_or_thread
+        kind, _ = SPEC[name]
+        value = getattr(config, name)
+        if kind == ID:
+            if value and find(value) is None:
+                foreign[name] = value
+        else:
+            missing = frozenset(v for v in value if find(v) is None)
+            if missing:
+                foreign[name] = missing
+    return foreign
+
+def confine(config: Config, guild):
+    """`config` without any channel or role ids from outside `guild`, so one server can never log into another"""
+    foreign = foreign_ids(config, guild)
+    if not foreign:
+        return config
+    print(f'Ignoring {", ".join(sorted(foreign))} for server {guild.id}, not in that server')
+    confined = _copy(config)
+    for name, ids in foreign.items():
+        kind, _ = SPEC[name]
+        object.__setattr__(confined, name, getattr(config, name) - ids if kind == IDS else None)
+    return confined
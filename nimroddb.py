@@ -1,50 +1,694 @@
 import aiosqlite
+import asyncio
+import json
+import time
 import uuid
+from ttlcache import TTLCache
+from contextlib import asynccontextmanager
 
-async def add_warn(server_id: int, user_id: int, moderator_id: int, datestamp: str, reason: str):
+DB_PATH = 'nimrod.db'
+READER_COUNT = 3
+WRITE_BATCH = 64
+WARN_CACHE_SIZE = 512
+WARN_CACHE_TTL = 300
+
+# values of warnings.action_type, and how they're shown
+ACTION_TYPES = {
+    'warn': 'Warning',
+    'flag': 'Flag',
+    'mute': 'Mute',
+    'ban': 'Ban',
+    'forum_ban': 'Forum ban',
+}
+
+PRAGMAS = [
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA busy_timeout = 5000',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA mmap_size = 134217728',
+]
+
+def _rollup_columns(row: str):
+    """The rollup key columns of a warnings row. NULLs become 0, primary keys can't hold them"""
+    return {
+        'server_id': f'coalesce({row}.server_id, 0)',
+        'day': f'CAST(coalesce({row}.datestamp, 0) AS INT) / 86400',
+        'moderator_id': f'coalesce({row}.moderator_id, 0)',
+        'user_id': f'coalesce({row}.user_id, 0)',
+        'action_type': f'{row}.action_type',
+    }
+
+# migrations 6 and 8 are built from these, so changing them takes a new migration
+ROLLUPS = {
+    'mod_daily': ('server_id', 'day', 'moderator_id', 'action_type'),
+    'user_daily': ('server_id', 'day', 'user_id'),
+}
+
+def _rollup_add(row: str):
+    columns = _rollup_columns(row)
+    statements = []
+    for table, key in ROLLUPS.items():
+        values = ', '.join(columns[c] for c in key)
+        statements.append(f'''INSERT INTO {table} ({', '.join(key)}, count) VALUES ({values}, 1)
+                ON CONFLICT ({', '.join(key)}) DO UPDATE SET count = count + 1;''')
+    return '\n            '.join(statements)
+
+def _rollup_remove(row: str):
+    columns = _rollup_columns(row)
+    statements = []
+    for table, key in ROLLUPS.items():
+        where = ' AND '.join(f'{c} = {columns[c]}' for c in key)
+        statements.append(f'UPDATE {table} SET count = count - 1 WHERE {where};')
+        statements.append(f'DELETE FROM {table} WHERE {where} AND count <= 0;')
+    return '\n            '.join(statements)
+
+def _rollup_triggers():
+    return [
+        f'''CREATE TRIGGER IF NOT EXISTS warnings_rollup_insert AFTER INSERT ON warnings BEGIN
+            {_rollup_add('new')}
+        END''',
+        f'''CREATE TRIGGER IF NOT EXISTS warnings_rollup_delete AFTER DELETE ON warnings BEGIN
+            {_rollup_remove('old')}
+        END''',
+        f'''CREATE TRIGGER IF NOT EXISTS warnings_rollup_update AFTER UPDATE OF server_id, user_id, moderator_id, datestamp, action_type ON warnings BEGIN
+            {_rollup_remove('old')}
+            {_rollup_add('new')}
+        END''',
+    ]
+
+def _rollup_backfill(table: str):
+    key = ROLLUPS[table]
+    columns = _rollup_columns('warnings')
+    return f'''INSERT INTO {table} ({', '.join(key)}, count)
+            SELECT {', '.join(columns[c] for c in key)}, COUNT(*) FROM warnings GROUP BY {', '.join(str(i + 1) for i in range(len(key)))}'''
+
+MIGRATIONS = [
+    # 1: the original schema from the README
+    [
+        '''CREATE TABLE IF NOT EXISTS warnings(
+            id TEXT PRIMARY KEY NOT NULL,
+            server_id INT,
+            user_id INT,
+            moderator_id INT,
+            datestamp INT,
+            reason TEXT
+        )''',
+        '''CREATE TABLE IF NOT EXISTS flags(
+            id TEXT PRIMARY KEY NOT NULL,
+            server_id INT,
+            user_id INT,
+            moderator_id INT,
+            datestamp INT
+        )''',
+        '''CREATE TABLE IF NOT EXISTS warn_message(
+            warn_id TEXT,
+            channel_id INT,
+            message_id INT
+        )''',
+    ],
+    # 2: indexes for the /warnings lookup and its join
+    [
+        'CREATE INDEX IF NOT EXISTS warnings_server_user_date ON warnings(server_id, user_id, datestamp)',
+        'CREATE INDEX IF NOT EXISTS warn_message_warn_id ON warn_message(warn_id)',
+        'ANALYZE',
+    ],
+    # 3: messages pushed out of the in-memory message store
+    [
+        '''CREATE TABLE IF NOT EXISTS stored_messages(
+            id INT PRIMARY KEY NOT NULL,
+            guild_id INT,
+            channel_id INT,
+            author_id INT,
+            author_name TEXT,
+            content TEXT,
+            created_at INT,
+            reference_id INT,
+            attachments TEXT,
+            sticker TEXT
+        )''',
+        'CREATE INDEX IF NOT EXISTS stored_messages_created_at ON stored_messages(created_at)',
+    ],
+    # 4: per server settings, values are JSON
+    [
+        '''CREATE TABLE IF NOT EXISTS guild_settings(
+            guild_id INT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT,
+            PRIMARY KEY (guild_id, key)
+        )''',
+    ],
+    # 5: action type column and full text search over reasons for /warnsearch
+    [
+        "ALTER TABLE warnings ADD COLUMN action_type TEXT NOT NULL DEFAULT 'warn'",
+        '''UPDATE warnings SET action_type = CASE
+            WHEN reason LIKE '(FLAG)%' THEN 'flag'
+            WHEN reason LIKE '(MUTE)%' THEN 'mute'
+            WHEN reason LIKE '(BAN)%' THEN 'ban'
+            WHEN reason LIKE '(FORUM BAN)%' THEN 'forum_ban'
+            ELSE 'warn' END''',
+        'CREATE INDEX IF NOT EXISTS warnings_server_date ON warnings(server_id, datestamp)',
+        'CREATE INDEX IF NOT EXISTS warnings_server_action_date ON warnings(server_id, action_type, datestamp)',
+        'CREATE INDEX IF NOT EXISTS warnings_server_moderator_date ON warnings(server_id, moderator_id, datestamp)',
+        # external content table keyed on the warnings rowid, which VACUUM
+        # may renumber, so VACUUM has to be followed by a 'rebuild'
+        "CREATE VIRTUAL TABLE IF NOT EXISTS warnings_fts USING fts5(reason, content='warnings', content_rowid='rowid', tokenize='porter unicode61 remove_diacritics 2')",
+        '''CREATE TRIGGER IF NOT EXISTS warnings_fts_insert AFTER INSERT ON warnings BEGIN
+            INSERT INTO warnings_fts(rowid, reason) VALUES (new.rowid, new.reason);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS warnings_fts_delete AFTER DELETE ON warnings BEGIN
+            INSERT INTO warnings_fts(warnings_fts, rowid, reason) VALUES ('delete', old.rowid, old.reason);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS warnings_fts_update AFTER UPDATE OF reason ON warnings BEGIN
+            INSERT INTO warnings_fts(warnings_fts, rowid, reason) VALUES ('delete', old.rowid, old.reason);
+            INSERT INTO warnings_fts(rowid, reason) VALUES (new.rowid, new.reason);
+        END''',
+        "INSERT INTO warnings_fts(warnings_fts) VALUES ('rebuild')",
+        'ANALYZE',
+    ],
+    # 6: per day counts for /modstats, kept up to date by triggers
+    [
+        '''CREATE TABLE IF NOT EXISTS mod_daily(
+            server_id INT NOT NULL,
+            day INT NOT NULL,
+            moderator_id INT NOT NULL,
+            action_type TEXT NOT NULL,
+            count INT NOT NULL,
+            PRIMARY KEY (server_id, day, moderator_id, action_type)
+        ) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS user_daily(
+            server_id INT NOT NULL,
+            day INT NOT NULL,
+            user_id INT NOT NULL,
+            count INT NOT NULL,
+            PRIMARY KEY (server_id, day, user_id)
+        ) WITHOUT ROWID''',
+        *_rollup_triggers(),
+        # backfill from the warnings already there
+        _rollup_backfill('mod_daily'),
+        _rollup_backfill('user_daily'),
+    ],
+    # 7: what the slash commands looked like when they were last synced
+    [
+        '''CREATE TABLE IF NOT EXISTS command_hashes(
+            application_id INT NOT NULL,
+            guild_id INT NOT NULL,
+            hash TEXT NOT NULL,
+            PRIMARY KEY (application_id, guild_id)
+        )''',
+    ],
+    # 8: an INTEGER PRIMARY KEY on warnings for the full text index to key
+    # on. Migration 5 keyed it on the implicit rowid, which VACUUM is free to
+    # renumber on a table with a TEXT primary key, leaving search results
+    # pointing at the wrong warnings. The table is copied over keeping the
+    # current rowids, and dropping the old one takes its indexes and triggers
+    [
+        'DROP TABLE IF EXISTS warnings_fts',
+        '''CREATE TABLE warnings_new(
+            seq INTEGER PRIMARY KEY,
+            id TEXT UNIQUE NOT NULL,
+            server_id INT,
+            user_id INT,
+            moderator_id INT,
+            datestamp INT,
+            reason TEXT,
+            action_type TEXT NOT NULL DEFAULT 'warn'
+        )''',
+        '''INSERT INTO warnings_new (seq, id, server_id, user_id, moderator_id, datestamp, reason, action_type)
+            SELECT rowid, id, server_id, user_id, moderator_id, datestamp, reason, action_type FROM warnings''',
+        'DROP TABLE warnings',
+        'ALTER TABLE warnings_new RENAME TO warnings',
+        'CREATE INDEX IF NOT EXISTS warnings_server_user_date ON warnings(server_id, user_id, datestamp)',
+        'CREATE INDEX IF NOT EXISTS warnings_server_date ON warnings(server_id, datestamp)',
+        'CREATE INDEX IF NOT EXISTS warnings_server_action_date ON warnings(server_id, action_type, datestamp)',
+        'CREATE INDEX IF NOT EXISTS warnings_server_moderator_date ON warnings(server_id, moderator_id, datestamp)',
+        "CREATE VIRTUAL TABLE IF NOT EXISTS warnings_fts USING fts5(reason, content='warnings', content_rowid='seq', tokenize='porter unicode61 remove_diacritics 2')",
+        '''CREATE TRIGGER IF NOT EXISTS warnings_fts_insert AFTER INSERT ON warnings BEGIN
+            INSERT INTO warnings_fts(rowid, reason) VALUES (new.seq, new.reason);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS warnings_fts_delete AFTER DELETE ON warnings BEGIN
+            INSERT INTO warnings_fts(warnings_fts, rowid, reason) VALUES ('delete', old.seq, old.reason);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS warnings_fts_update AFTER UPDATE OF reason ON warnings BEGIN
+            INSERT INTO warnings_fts(warnings_fts, rowid, reason) VALUES ('delete', old.seq, old.reason);
+            INSERT INTO warnings_fts(rowid, reason) VALUES (new.seq, new.reason);
+        END''',
+        "INSERT INTO warnings_fts(warnings_fts) VALUES ('rebuild')",
+        *_rollup_triggers(),
+        'ANALYZE',
+    ],
+]
+
+_writer = None
+_write_lock = None
+_readers = None
+_all_readers = []
+_write_queue = None
+_write_task = None
+
+# /warnings results keyed by (server_id, user_id, query), grouped by
+# (server_id, user_id) so a write can drop all of a user's pages at once
+warn_cache = TTLCache(WARN_CACHE_SIZE, WARN_CACHE_TTL)
+
+async def _open(path: str, readonly: bool=False):
+    # isolation_level=None lets us issue BEGIN/COMMIT ourselves, and
+    # cached_statements keeps the prepared statements for our handful of
+    # queries alive on each long lived connection
+    db = await aiosqlite.connect(path, isolation_level=None, cached_statements=64)
+    for pragma in PRAGMAS:
+        await db.execute(pragma)
+    if readonly:
+        await db.execute('PRAGMA query_only = ON')
+    db.row_factory = aiosqlite.Row
+    return db
+
+async def connect(path: str=DB_PATH, readers: int=READER_COUNT, schema: int=None, cache_size: int=WARN_CACHE_SIZE, cache_ttl: float=WARN_CACHE_TTL):
+    """Open the shared writer connection and the reader pool"""
+    global _writer, _write_lock, _readers, _all_readers, _write_queue, _write_task, warn_cache
+    if _writer is not None:
+        return
+
+    warn_cache = TTLCache(cache_size, cache_ttl)
+
+    _writer = await _open(path)
+    _write_lock = asyncio.Lock()
+    await migrate(schema)
+    _readers = asyncio.Queue()
+    _all_readers = []
+    for _ in range(readers):
+        db = await _open(path, readonly=True)
+        _all_readers.append(db)
+        _readers.put_nowait(db)
+    _write_queue = asyncio.Queue()
+    _write_task = asyncio.create_task(_write_behind())
+
+async def close():
+    """Flush queued writes, then close every pooled connection, checkpointing the WAL on the way out"""
+    global _writer, _readers, _all_readers, _write_queue, _write_task
+    if _writer is None:
+        return
+
+    _write_queue.put_nowait(None)
+    await _write_task
+    _write_queue = None
+    _write_task = None
+
+    for db in _all_readers:
+        await db.close()
     try:
-        async with aiosqlite.connect('nimrod.db') as db:
-            the_uuid = str(uuid.uuid4())
-            await db.execute('INSERT INTO warnings (id, server_id, user_id, moderator_id, datestamp, reason) VALUES (?, ?, ?, ?, ?, ?)', (the_uuid, server_id, user_id, moderator_id, datestamp, reason))
-            await db.commit()
-            return the_uuid
+        await _writer.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    except Exception as e:
+        print('Failed to checkpoint database:')
+        print(e)
+    await _writer.close()
+    _writer = None
+    _readers = None
+    _all_readers = []
+
+@asynccontextmanager
+async def reader():
+    db = await _readers.get()
+    try:
+        yield db
+    finally:
+        _readers.put_nowait(db)
+
+@asynccontextmanager
+async def transaction():
+    async with _write_lock:
+        await _writer.execute('BEGIN IMMEDIATE')
+        try:
+            yield _writer
+            await _writer.execute('COMMIT')
+        except BaseException:
+            # a failed COMMIT can leave the transaction open, and then every
+            # later BEGIN fails until the bot is restarted
+            if _writer.in_transaction:
+                await _writer.execute('ROLLBACK')
+            raise
+
+async def _write_behind():
+    # everything queued while the previous batch was committing goes into
+    # the next transaction, so a burst of writes costs one fsync per batch
+    # rather than one per write
+    running = True
+    while running:
+        job = await _write_queue.get()
+        if job is None:
+            break
+        batch = [job]
+        while len(batch) < WRITE_BATCH and not _write_queue.empty():
+            job = _write_queue.get_nowait()
+            if job is None:
+                running = False
+                break
+            batch.append(job)
+        await _commit_batch(batch)
+
+async def _commit_batch(batch):
+    results = []
+    try:
+        async with transaction() as db:
+            for op, future in batch:
+                # a savepoint per write keeps one bad write from taking the
+                # rest of the batch down with it
+                await db.execute('SAVEPOINT write')
+                try:
+                    results.append((future, await op(db), None))
+                    await db.execute('RELEASE write')
+                except Exception as e:
+                    await db.execute('ROLLBACK TO write')
+                    await db.execute('RELEASE write')
+                    results.append((future, None, e))
+    except Exception as e:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+        return
+
+    # only report back once the batch has been committed
+    for future, result, error in results:
+        if future.done():
+            continue
+        if error:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+async def write(op):
+    """Queue `op(db)` for the next batched commit and wait for its result"""
+    future = asyncio.get_running_loop().create_future()
+    _write_queue.put_nowait((op, future))
+    return await future
+
+async def schema_version():
+    async with _writer.execute('PRAGMA user_version') as cursor:
+        row = await cursor.fetchone()
+    return row[0]
+
+async def migrate(target: int=None):
+    """Bring the schema up to `target` (default latest), one transaction per migration"""
+    if target is None:
+        target = len(MIGRATIONS)
+    while True:
+        # the version is read inside the write transaction, so processes
+        # sharing the database can't both apply the same migration
+        async with transaction() as db:
+            async with db.execute('PRAGMA user_version') as cursor:
+                version = (await cursor.fetchone())[0]
+            if version >= target:
+                return
+            for statement in MIGRATIONS[version]:
+                await db.execute(statement)
+            version += 1
+            # PRAGMA doesn't take bound parameters
+            await db.execute(f'PRAGMA user_version = {version:d}')
+        print(f'Migrated database to schema version {version}')
+
+async def add_warn(server_id: int, user_id: int, moderator_id: int, datestamp: str, reason: str, channel_id: int=None, message_id: int=None, action_type: str='warn'):
+    the_uuid = str(uuid.uuid4())
+
+    async def op(db):
+        await db.execute('INSERT INTO warnings (id, server_id, user_id, moderator_id, datestamp, reason, action_type) VALUES (?, ?, ?, ?, ?, ?, ?)', (the_uuid, server_id, user_id, moderator_id, datestamp, reason, action_type))
+        if message_id is not None:
+            await db.execute('INSERT INTO warn_message (warn_id, channel_id, message_id) VALUES (?, ?, ?)', (the_uuid, channel_id, message_id))
+        return the_uuid
+
+    try:
+        await write(op)
     except Exception as e:
         print('Failed to add warn:')
         print(e, user_id, datestamp)
         return False
+    warn_cache.invalidate((server_id, user_id))
+    return the_uuid
+
+async def del_warn(server_id: int, warn_id: str):
+    """True once deleted, None if the server has no such warning, False on a database error"""
+    async def op(db):
+        # only ever the server's own warnings
+        async with db.execute('SELECT server_id, user_id FROM warnings WHERE id = ? AND server_id = ?', (warn_id, server_id)) as cursor:
+            owner = await cursor.fetchone()
+        if owner is None:
+            return None
+        await db.execute('DELETE FROM warnings WHERE id = ?', (warn_id,))
+        await db.execute('DELETE FROM warn_message WHERE warn_id = ?', (warn_id,))
+        return owner
 
-async def del_warn(warn_id: str):
     try:
-        async with aiosqlite.connect('nimrod.db') as db:
-            await db.execute('DELETE FROM warnings WHERE id = ?', (warn_id,))
-            await db.commit()
-        return True
+        owner = await write(op)
     except Exception as e:
         print('Failed to delete warning:')
         print(e, warn_id)
         return False
+    if owner is None:
+        return None
+    warn_cache.invalidate(tuple(owner))
+    return True
+
+async def count_warns(server_id: int, user_id: int):
+    key = (server_id, user_id, 'count')
+    count = warn_cache.get(key)
+    if count is not None:
+        return count
 
-async def list_warns(user_id: int):
     try:
+        generation = warn_cache.generation
+        async with reader() as db:
+            async with db.execute('SELECT COUNT(*) FROM warnings WHERE server_id = ? AND user_id = ?', (server_id, user_id)) as cursor:
+                row = await cursor.fetchone()
+        warn_cache.set(key, row[0], generation, group=(server_id, user_id))
+        return row[0]
+    except Exception as e:
+        print('Failed to count warns:')
+        print(e, user_id)
+        return False
+
+async def list_warns(server_id: int, user_id: int, before: tuple=None, limit: int=-1):
+    """Newest first. `before` is the (datestamp, id) of the last row of the previous page"""
+    key = (server_id, user_id, before, limit)
+    out = warn_cache.get(key)
+    if out is not None:
+        return list(out)
+
+    try:
+        generation = warn_cache.generation
         out = []
-        async with aiosqlite.connect('nimrod.db') as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute('SELECT * FROM warnings LEFT JOIN warn_message ON warnings.id = warn_message.warn_id WHERE user_id = ?', (user_id,)) as cursor:
+        query = 'SELECT warnings.id, moderator_id, datestamp, reason, channel_id, message_id FROM warnings LEFT JOIN warn_message ON warnings.id = warn_message.warn_id WHERE server_id = ? AND user_id = ?'
+        params = [server_id, user_id]
+        if before:
+            query += ' AND (datestamp, warnings.id) < (?, ?)'
+            params += before
+        query += ' ORDER BY datestamp DESC, warnings.id DESC LIMIT ?'
+        params.append(limit)
+        async with reader() as db:
+            async with db.execute(query, params) as cursor:
                 async for row in cursor:
                     out.append(row)
+        warn_cache.set(key, tuple(out), generation, group=(server_id, user_id))
         return out
     except Exception as e:
         print('Failed to list warns:')
         print(e, user_id)
         return False
 
-async def add_warn_message_id(warn_id, channel_id, message_id):
+def match_query(text: str):
+    """
+    An FTS5 query matching every word of `text`. Words are quoted so
+    punctuation can't be taken for query syntax; a trailing * still makes
+    a word a prefix.
+    """
+    terms = []
+    for word in text.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*').replace('"', '""')
+        if word:
+            terms.append(f'"{word}"' + ('*' if prefix else ''))
+    return ' '.join(terms)
+
+def _search_filter(server_id: int, text: str, moderator_id: int, action_type: str, since: int, until: int):
+    if text:
+        # CROSS JOIN keeps the match as the outer loop, otherwise the
+        # planner may walk the server's rows and run the match per row
+        query = ' FROM warnings_fts CROSS JOIN warnings ON warnings.seq = warnings_fts.rowid LEFT JOIN warn_message ON warnings.id = warn_message.warn_id WHERE warnings_fts MATCH ? AND server_id = ?'
+        params = [match_query(text), server_id]
+    else:
+        query = ' FROM warnings LEFT JOIN warn_message ON warnings.id = warn_message.warn_id WHERE server_id = ?'
+        params = [server_id]
+    if moderator_id is not None:
+        query += ' AND moderator_id = ?'
+        params.append(moderator_id)
+    if action_type is not None:
+        query += ' AND action_type = ?'
+        params.append(action_type)
+    if since is not None:
+        query += ' AND datestamp >= ?'
+        params.append(since)
+    if until is not None:
+        query += ' AND datestamp < ?'
+        params.append(until)
+    return query, params
+
+async def count_search(server_id: int, text: str=None, moderator_id: int=None, action_type: str=None, since: int=None, until: int=None):
+    try:
+        query, params = _search_filter(server_id, text, moderator_id, action_type, since, until)
+        async with reader() as db:
+            async with db.execute('SELECT COUNT(*)' + query, params) as cursor:
+                return (await cursor.fetchone())[0]
+    except Exception as e:
+        print('Failed to count warning search:')
+        print(e, text)
+        return False
+
+async def search_warns(server_id: int, text: str=None, moderator_id: int=None, action_type: str=None, since: int=None, until: int=None, after: tuple=None, limit: int=-1):
+    """
+    Warnings matching every filter. With `text` they come best match first
+    (bm25), otherwise newest first; `after` is the `cursor` of the last row
+    of the previous page.
+    """
+    try:
+        query, params = _search_filter(server_id, text, moderator_id, action_type, since, until)
+        columns = 'SELECT warnings.id, user_id, moderator_id, datestamp, warnings.reason, action_type, channel_id, message_id'
+        if text:
+            # the rank is only known once the match has run, so the page
+            # boundary is applied around it
+            query = f'SELECT * FROM ({columns}, bm25(warnings_fts) AS score, warnings.seq AS position{query})'
+            if after:
+                query += ' WHERE (score, position) > (?, ?)'
+                params += after
+            query += ' ORDER BY score, position LIMIT ?'
+        else:
+            query = f'{columns}, datestamp AS score, warnings.id AS position{query}'
+            if after:
+                query += ' AND (datestamp, warnings.id) < (?, ?)'
+                params += after
+            query += ' ORDER BY datestamp DESC, warnings.id DESC LIMIT ?'
+        params.append(limit)
+        async with reader() as db:
+            async with db.execute(query, params) as cursor:
+                return await cursor.fetchall()
+    except Exception as e:
+        print('Failed to search warnings:')
+        print(e, text)
+        return False
+
+async def get_command_hashes(application_id: int):
+    """{guild_id: hash} of the commands last synced by this application"""
+    try:
+        async with reader() as db:
+            async with db.execute('SELECT guild_id, hash FROM command_hashes WHERE application_id = ?', (application_id,)) as cursor:
+                return {row['guild_id']: row['hash'] for row in await cursor.fetchall()}
+    except Exception as e:
+        print('Failed to get command hashes:')
+        print(e)
+        return False
+
+async def set_command_hash(application_id: int, guild_id: int, digest: str):
+    async def op(db):
+        await db.execute('INSERT OR REPLACE INTO command_hashes (application_id, guild_id, hash) VALUES (?, ?, ?)', (application_id, guild_id, digest))
+
+    try:
+        await write(op)
+    except Exception as e:
+        print('Failed to save command hash:')
+        print(e, guild_id)
+        return False
+    return True
+
+async def mod_stats(server_id: int, since: int):
+    """(moderator_id, action_type, count) for actions on or after day `since` (days since the epoch, UTC)"""
+    try:
+        async with reader() as db:
+            async with db.execute('SELECT moderator_id, action_type, SUM(count) FROM mod_daily WHERE server_id = ? AND day >= ? GROUP BY moderator_id, action_type', (server_id, since)) as cursor:
+                return [tuple(row) for row in await cursor.fetchall()]
+    except Exception as e:
+        print('Failed to get mod stats:')
+        print(e, server_id)
+        return False
+
+async def repeat_offenders(server_id: int, since: int, minimum: int=2, limit: int=10):
+    """(user_id, count) of the users with at least `minimum` warnings on or after day `since`, most first"""
+    try:
+        async with reader() as db:
+            async with db.execute('SELECT user_id, SUM(count) AS total FROM user_daily WHERE server_id = ? AND day >= ? GROUP BY user_id HAVING total >= ? ORDER BY total DESC, user_id LIMIT ?', (server_id, since, minimum, limit)) as cursor:
+                return [tuple(row) for row in await cursor.fetchall()]
+    except Exception as e:
+        print('Failed to get repeat offenders:')
+        print(e, server_id)
+        return False
+
+async def store_messages(rows: list, max_age: float=None):
+    """Save message store rows, dropping any saved more than `max_age` seconds before now"""
+    async def op(db):
+        if rows:
+            await db.executemany('INSERT OR REPLACE INTO stored_messages (id, guild_id, channel_id, author_id, author_name, content, created_at, reference_id, attachments, sticker) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        if max_age is not None:
+            await db.execute('DELETE FROM stored_messages WHERE created_at < ?', (time.time() - max_age,))
+
+    try:
+        await write(op)
+    except Exception as e:
+        print('Failed to store messages:')
+        print(e, len(rows))
+
+async def get_stored_message(message_id: int):
+    try:
+        async with reader() as db:
+            async with db.execute('SELECT * FROM stored_messages WHERE id = ?', (message_id,)) as cursor:
+                return await cursor.fetchone()
+    except Exception as e:
+        print('Failed to get stored message:')
+        print(e, message_id)
+        return None
+
+async def get_stored_messages(message_ids: list):
+    try:
+        placeholders = ', '.join('?' * len(message_ids))
+        async with reader() as db:
+            async with db.execute(f'SELECT * FROM stored_messages WHERE id IN ({placeholders})', message_ids) as cursor:
+                return await cursor.fetchall()
+    except Exception as e:
+        print('Failed to get stored messages:')
+        print(e, len(message_ids))
+        return False
+
+async def delete_stored_messages(message_ids: list):
+    async def op(db):
+        await db.executemany('DELETE FROM stored_messages WHERE id = ?', [(message_id,) for message_id in message_ids])
+
+    try:
+        await write(op)
+    except Exception as e:
+        print('Failed to delete stored messages:')
+        print(e, len(message_ids))
+
+async def get_guild_settings():
+    """Every server's settings, as {guild_id: {key: value}}"""
+    out = {}
+    try:
+        async with reader() as db:
+            async with db.execute('SELECT guild_id, key, value FROM guild_settings') as cursor:
+                async for row in cursor:
+                    out.setdefault(row['guild_id'], {})[row['key']] = json.loads(row['value'])
+    except Exception as e:
+        print('Failed to get guild settings:')
+        print(e)
+        return False
+    return out
+
+async def set_guild_setting(guild_id: int, key: str, value):
+    """Save one setting for a server, or clear it when `value` is None"""
+    async def op(db):
+        if value is None:
+            await db.execute('DELETE FROM guild_settings WHERE guild_id = ? AND key = ?', (guild_id, key))
+        else:
+            await db.execute('INSERT OR REPLACE INTO guild_settings (guild_id, key, value) VALUES (?, ?, ?)', (guild_id, key, json.dumps(value)))
+
     try:
-        async with aiosqlite.connect('nimrod.db') as db:
-            await db.execute('INSERT INTO warn_message (warn_id, channel_id, message_id) VALUES (?, ?, ?)', (warn_id, channel_id, message_id))
-            await db.commit()
-        return True
+        await write(op)
     except Exception as e:
-        print('Failed to add warn message id:')
-        print(e, warn_id, channel_id, message_id)
+        print('Failed to save guild setting:')
+        print(e, guild_id, key)
         return False
+    return True
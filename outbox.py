@@ -0,0 +1,164 @@
+import asyncio
+import discord
+from collections import deque
+
+HIGH = 0
+LOW = 1
+
+MAX_EMBEDS = 10
+MAX_EMBED_CHARS = 6000
+
+class Outgoing:
+    __slots__ = ('content', 'embeds', 'files', 'view', 'future')
+
+    def __init__(self, content, embeds, files, view, future):
+        self.content = content
+        self.embeds = embeds
+        self.files = files
+        self.view = view
+        self.future = future
+
+    def packable(self):
+        return not (self.content or self.files or self.view)
+
+class ChannelQueue:
+    __slots__ = ('queues', 'dropped', 'worker')
+
+    def __init__(self):
+        self.queues = (deque(), deque())
+        self.dropped = 0
+        self.worker = None
+
+    def __len__(self):
+        return len(self.queues[HIGH]) + len(self.queues[LOW])
+
+class Outbox:
+    """
+    Every log channel send goes through here. Each channel gets its own
+    queue and a worker that only exists while there is something to
+    send; moderator action logs (HIGH) jump ahead of passive event logs
+    (LOW), and runs of plain embeds are packed up to 10 to a message.
+
+    When a channel's queue is full new LOW entries are dropped (or the
+    oldest LOW entry, to make room for a HIGH one) and the worker posts a
+    count of what was lost once it catches up.
+    """
+    def __init__(self, max_queue: int=500):
+        self.max_queue = max_queue
+        self.channels = {}
+        # channel objects looked up ahead of time, by id. Only these are
+        # ever sent to, so a stray id can't post into some other server
+        self.targets = {}
+        self.sent = 0
+        self.requests = 0
+        self.dropped = 0
+
+    def _enqueue(self, channel_id: int, item: Outgoing, priority: int):
+        if channel_id is None:
+            # a log this server hasn't given a channel to
+            if item.future:
+                item.future.set_exception(LookupError('No log channel set'))
+            return
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            channel = self.channels[channel_id] = ChannelQueue()
+
+        if len(channel) >= self.max_queue:
+            if priority == LOW or not channel.queues[LOW]:
+                # HIGH entries are only ever dropped when the queue is all HIGH
+                dropped = item if priority == LOW else channel.queues[HIGH].popleft()
+            else:
+                dropped = channel.queues[LOW].popleft()
+            channel.dropped += 1
+            self.dropped += 1
+            if dropped.future and not dropped.future.done():
+                dropped.future.set_exception(OverflowError('Log queue full'))
+            if dropped is item:
+                return
+
+        channel.queues[priority].append(item)
+        if channel.worker is None:
+            channel.worker = asyncio.create_task(self._drain(channel_id, channel))
+
+    def send(self, channel_id: int, content: str=None, embed: discord.Embed=None, embeds: list=None, files: list=None, view: discord.ui.View=None, priority: int=LOW):
+        """Queue a message for `channel_id` without waiting for it to go out"""
+        if embed is not None:
+            embeds = [embed]
+        self._enqueue(channel_id, Outgoing(content, embeds or [], files, view, None), priority)
+
+    async def send_and_wait(self, channel_id: int, content: str=None, embed: discord.Embed=None, embeds: list=None, files: list=None, view: discord.ui.View=None, priority: int=HIGH):
+        """Queue a message and wait for the discord.Message it was sent as"""
+        if embed is not None:
+            embeds = [embed]
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(channel_id, Outgoing(content, embeds or [], files, view, future), priority)
+        return await future
+
+    def _next_batch(self, channel: ChannelQueue):
+        queue = channel.queues[HIGH] if channel.queues[HIGH] else channel.queues[LOW]
+        first = queue.popleft()
+        batch = [first]
+        if not first.packable():
+            return batch
+
+        embeds = len(first.embeds)
+        chars = sum(len(e) for e in first.embeds)
+        for queue in channel.queues:
+            while queue and queue[0].packable():
+                size = sum(len(e) for e in queue[0].embeds)
+                if embeds + len(queue[0].embeds) > MAX_EMBEDS or chars + size > MAX_EMBED_CHARS:
+                    return batch
+                embeds += len(queue[0].embeds)
+                chars += size
+                batch.append(queue.popleft())
+        return batch
+
+    async def _drain(self, channel_id: int, channel: ChannelQueue):
+        try:
+            while len(channel):
+                batch = self._next_batch(channel)
+                target = self.targets.get(channel_id)
+                try:
+                    if target is None:
+                        raise LookupError(f'Unknown log channel {channel_id}')
+                    first = batch[0]
+                    kwargs = {'embeds': [e for item in batch for e in item.embeds]}
+                    if first.content:
+                        kwargs['content'] = first.content
+                    if first.files:
+                        kwargs['files'] = first.files
+                    if first.view:
+                        kwargs['view'] = first.view
+                    message = await target.send(**kwargs)
+                    self.requests += 1
+                    self.sent += len(batch)
+                    for item in batch:
+                        if item.future and not item.future.done():
+                            item.future.set_result(message)
+                except Exception as e:
+                    print(f'Failed to send to log channel {channel_id}:')
+                    print(e)
+                    for item in batch:
+                        if item.future and not item.future.done():
+                            item.future.set_exception(e)
+
+                if channel.dropped and not len(channel):
+                    dropped, channel.dropped = channel.dropped, 0
+                    self.send(channel_id, f'_{dropped} log entries were dropped while this channel was backed up_')
+        finally:
+            channel.worker = None
+            if not len(channel):
+                self.channels.pop(channel_id, None)
+
+    async def flush(self, timeout: float=10):
+        workers = [c.worker for c in self.channels.values() if c.worker]
+        if workers:
+            await asyncio.wait(workers, timeout=timeout)
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'requests': self.requests,
+            'dropped': self.dropped,
+            'queued': {channel_id: len(channel) for channel_id, channel in self.channels.items()},
+        }
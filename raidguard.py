@@ -0,0 +1,96 @@
+import time
+from collections import deque
+
+# account age buckets (upper bound in seconds, label), youngest first
+AGE_BUCKETS = (
+    (60 * 60, '< 1 hour'),
+    (24 * 60 * 60, '< 1 day'),
+    (7 * 24 * 60 * 60, '< 1 week'),
+    (30 * 24 * 60 * 60, '< 1 month'),
+    (None, 'older'),
+)
+
+def age_bucket(age: float):
+    for i, (limit, _) in enumerate(AGE_BUCKETS):
+        if limit is None or age < limit:
+            return i
+
+class Raid:
+    __slots__ = ('started', 'last_join', 'joins', 'ages', 'actioned')
+
+    def __init__(self, now: float):
+        self.started = now
+        self.last_join = now
+        self.joins = 0
+        self.ages = [0] * len(AGE_BUCKETS)
+        self.actioned = 0
+
+    def add(self, age: float, now: float):
+        self.joins += 1
+        self.ages[age_bucket(age)] += 1
+        self.last_join = now
+
+    def describe_ages(self):
+        return '\n'.join(f'{label}: **{count}**' for (_, label), count in zip(AGE_BUCKETS, self.ages) if count)
+
+class RaidGuard:
+    """
+    Counts joins per guild over a sliding `window` of seconds. Once
+    `threshold` joins land inside one window the guild is in raid mode
+    until joins have stayed under the threshold for `cooldown` seconds.
+
+    Only the joins inside the window are kept, plus a handful of counters
+    per active raid.
+    """
+    def __init__(self, threshold: int=10, window: float=60, cooldown: float=300):
+        self.threshold = threshold
+        self.window = window
+        self.cooldown = cooldown
+        self.joins = {}
+        self.raids = {}
+
+    def join(self, guild_id: int, age: float, now: float=None):
+        """
+        Count a join by an account `age` seconds old. Returns the guild's
+        Raid if it is in raid mode, and whether this join started it.
+        """
+        if now is None:
+            now = time.monotonic()
+        joins = self.joins.get(guild_id)
+        if joins is None:
+            joins = self.joins[guild_id] = deque()
+        joins.append((now, age))
+        cutoff = now - self.window
+        while joins[0][0] <= cutoff:
+            joins.popleft()
+
+        raid = self.raids.get(guild_id)
+        if raid is not None:
+            raid.add(age, now)
+            return raid, False
+        if len(joins) < self.threshold:
+            return None, False
+
+        # the joins that tipped it over count towards the raid too
+        raid = self.raids[guild_id] = Raid(joins[0][0])
+        for timestamp, age in joins:
+            raid.add(age, timestamp)
+        return raid, True
+
+    def expire(self, now: float=None):
+        """Drop joins that left the window, and return (guild_id, Raid) for every raid that is over"""
+        if now is None:
+            now = time.monotonic()
+        cutoff = now - self.window
+        for guild_id in list(self.joins):
+            joins = self.joins[guild_id]
+            while joins and joins[0][0] <= cutoff:
+                joins.popleft()
+            if not joins:
+                del self.joins[guild_id]
+
+        ended = []
+        for guild_id, raid in list(self.raids.items()):
+            if raid.last_join <= now - self.cooldown and len(self.joins.get(guild_id, ())) < self.threshold:
+                ended.append((guild_id, self.raids.pop(guild_id)))
+        return ended
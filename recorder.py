@@ -0,0 +1,81 @@
+import gzip
+import json
+import time
+
+def _member(member):
+    return {
+        'id': member.id,
+        'name': member.name,
+        'bot': member.bot,
+        'nick': getattr(member, 'nick', None),
+        'roles': [r.name for r in getattr(member, 'roles', ())],
+        'avatar': bool(getattr(member, 'guild_avatar', None)),
+        'timed_out_until': member.timed_out_until.timestamp() if getattr(member, 'timed_out_until', None) else None,
+        'created_at': member.created_at.timestamp(),
+    }
+
+def _message(message):
+    return {
+        'id': message.id,
+        'guild': message.guild.id if message.guild else None,
+        'channel': message.channel.id,
+        'parent': getattr(message.channel, 'parent_id', None),
+        'author': _member(message.author),
+        'content': message.content,
+        'attachments': [[a.id, a.filename, a.size, a.width] for a in message.attachments],
+        'reference': message.reference.message_id if message.reference else None,
+        'edited': message.edited_at.timestamp() if message.edited_at else None,
+    }
+
+# gateway event name -> what to keep of its arguments
+ENCODERS = {
+    'message': lambda message: _message(message),
+    'raw_message_edit': lambda event: _message(event.message),
+    'raw_message_delete': lambda event: {'id': event.message_id, 'channel': event.channel_id, 'guild': event.guild_id},
+    'raw_bulk_message_delete': lambda event: {'ids': list(event.message_ids), 'channel': event.channel_id, 'guild': event.guild_id},
+    'member_update': lambda before, after: {'guild': after.guild.id, 'before': _member(before), 'after': _member(after)},
+    'member_join': lambda member: {'guild': member.guild.id, 'member': _member(member)},
+    'raw_member_remove': lambda event: {'guild': event.guild_id, 'member': _member(event.user)},
+}
+
+class EventRecorder:
+    """
+    Keeps a compact copy of the gateway events the bot handles, to replay
+    later with bench.replay. Capturing only copies the fields we need
+    (discord.py updates cached objects in place, so they can't wait);
+    `flush` does the JSON encoding and compression and appends the result
+    to `path` as another gzip member, so the file stays one valid gzip
+    stream of JSON lines:
+
+        [unix time, event name, payload]
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.pending = []
+        self.recorded = 0
+
+    def capture(self, event: str, args: tuple):
+        encoder = ENCODERS.get(event)
+        if encoder is None:
+            return
+        try:
+            self.pending.append([round(time.time(), 3), event, encoder(*args)])
+        except Exception as e:
+            print(f'Failed to record {event}: {e}')
+
+    def flush(self):
+        """Write everything captured so far. Blocking, so run it in a thread"""
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+        with gzip.open(self.path, 'at', encoding='utf8') as stream:
+            for entry in pending:
+                stream.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        self.recorded += len(pending)
+
+def read(path: str):
+    """Yield (unix time, event name, payload) from a recording"""
+    with gzip.open(path, 'rt', encoding='utf8') as stream:
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
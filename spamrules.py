@@ -0,0 +1,280 @@
+import heapq
+import re
+import time
+from spamtracker import SpamRecord, signature_hash
+
+LINK_RE = re.compile(r'https?://\S+', re.I)
+INVITE_RE = re.compile(r'(?:discord(?:app)?\.com/invite|discord\.gg)/\S+', re.I)
+SHINGLE_SIZE = 5
+MINHASH_SIZE = 32
+
+DEFAULT_RULES = [{'type': 'attachments', 'count': 4, 'repeats': 3}]
+
+def normalize(text: str):
+    return ' '.join(text.lower().split())
+
+def minhash(text: str):
+    """Bottom-k MinHash sketch of the text's character shingles"""
+    shingles = {hash(text[i:i + SHINGLE_SIZE]) for i in range(max(1, len(text) - SHINGLE_SIZE + 1))}
+    return tuple(heapq.nsmallest(MINHASH_SIZE, shingles))
+
+def similarity(a: tuple, b: tuple):
+    """Estimated Jaccard similarity of two minhash sketches"""
+    a, b = set(a), set(b)
+    union = heapq.nsmallest(MINHASH_SIZE, a | b)
+    if not union:
+        return 0
+    return sum(1 for h in union if h in a and h in b) / len(union)
+
+class Features:
+    """Everything the rules look at, worked out once per message"""
+    __slots__ = ('user_id', 'channel_id', 'message_id', 'timestamp', 'images', 'text', 'signature', 'text_signature', 'minhash', 'links', 'invites')
+
+    def record(self):
+        return SpamRecord(self.signature, self.timestamp, self.channel_id, self.message_id, self.minhash, self.links, self.invites)
+
+class Match:
+    __slots__ = ('rule', 'features')
+
+    def __init__(self, rule, features):
+        self.rule = rule
+        self.features = features
+
+class Rule:
+    """
+    A rule first says whether it cares about a message at all (`wants`,
+    which has to be cheap), then gets shown each of the user's recent
+    records in turn (`observe`) and finally decides (`matched`).
+    `related` picks out the records to clean up once it has matched.
+    """
+    def __init__(self, window: float=None):
+        self.window = window
+
+    def in_window(self, record, f):
+        return self.window is None or record.timestamp >= f.timestamp - self.window
+
+    def wants(self, f):
+        return False
+
+    def start(self, f):
+        return [1]
+
+    def observe(self, state, record, f):
+        pass
+
+    def matched(self, state, f):
+        return False
+
+    def related(self, record, f):
+        return record.signature == f.signature
+
+class AttachmentsRule(Rule):
+    """The same set of `count` images posted `repeats` times"""
+    def __init__(self, count: int=4, repeats: int=3, window: float=None):
+        super().__init__(window)
+        self.count = count
+        self.repeats = repeats
+
+    def describe(self):
+        return f'Same {self.count} images posted {self.repeats} times'
+
+    def wants(self, f):
+        return f.images == self.count
+
+    def observe(self, state, record, f):
+        if record.signature == f.signature and self.in_window(record, f):
+            state[0] += 1
+
+    def matched(self, state, f):
+        return state[0] >= self.repeats
+
+class ChannelSpreadRule(Rule):
+    """
+    The same message (or set of images) posted in `channels` different
+    channels, optionally only counting `watch`ed ones. Text only counts
+    from `min_length` characters, so a "gm" in a few channels isn't spam.
+    """
+    def __init__(self, channels: int=3, watch: list=None, min_length: int=20, window: float=None):
+        super().__init__(window)
+        self.channels = channels
+        self.watch = frozenset(watch or ())
+        self.min_length = min_length
+        if self.watch and channels > len(self.watch):
+            raise ValueError(f'channel_spread only watches {len(self.watch)} channels, so it can never see {channels}')
+
+    def describe(self):
+        return f'Same message posted in {self.channels} channels'
+
+    def watched(self, channel_id):
+        return not self.watch or channel_id in self.watch
+
+    def wants(self, f):
+        if f.signature is None or (f.text_signature and len(f.text) < self.min_length):
+            return False
+        return self.watched(f.channel_id)
+
+    def start(self, f):
+        return {f.channel_id}
+
+    def observe(self, state, record, f):
+        if record.signature == f.signature and self.watched(record.channel_id) and self.in_window(record, f):
+            state.add(record.channel_id)
+
+    def matched(self, state, f):
+        return len(state) >= self.channels
+
+class DuplicateTextRule(Rule):
+    """`repeats` messages of at least `min_length` characters that are at least `similarity` alike"""
+    def __init__(self, repeats: int=3, similarity: float=0.8, min_length: int=30, window: float=None):
+        super().__init__(window)
+        self.repeats = repeats
+        self.similarity = similarity
+        self.min_length = min_length
+
+    def describe(self):
+        return f'Near-duplicate message posted {self.repeats} times'
+
+    def wants(self, f):
+        return f.minhash is not None and len(f.text) >= self.min_length
+
+    def observe(self, state, record, f):
+        if record.minhash and self.in_window(record, f) and similarity(record.minhash, f.minhash) >= self.similarity:
+            state[0] += 1
+
+    def matched(self, state, f):
+        return state[0] >= self.repeats
+
+    def related(self, record, f):
+        return record.minhash is not None and similarity(record.minhash, f.minhash) >= self.similarity
+
+class LinkBurstRule(Rule):
+    """At least `links` links or `invites` server invites posted within the window"""
+    def __init__(self, links: int=None, invites: int=None, window: float=None):
+        super().__init__(window)
+        self.links = links
+        self.invites = invites
+
+    def describe(self):
+        limits = []
+        if self.links:
+            limits.append(f'{self.links} links')
+        if self.invites:
+            limits.append(f'{self.invites} invites')
+        return f'Burst of {" or ".join(limits)}'
+
+    def wants(self, f):
+        return (self.links and f.links) or (self.invites and f.invites)
+
+    def start(self, f):
+        return [f.links, f.invites]
+
+    def observe(self, state, record, f):
+        if self.in_window(record, f):
+            state[0] += record.links
+            state[1] += record.invites
+
+    def matched(self, state, f):
+        return bool((self.links and state[0] >= self.links) or (self.invites and state[1] >= self.invites))
+
+    def related(self, record, f):
+        return record.links > 0 or record.invites > 0
+
+RULE_TYPES = {
+    'attachments': AttachmentsRule,
+    'channel_spread': ChannelSpreadRule,
+    'duplicate_text': DuplicateTextRule,
+    'link_burst': LinkBurstRule,
+}
+
+class SpamEngine:
+    """
+    Runs every configured rule over a message in one pass of the user's
+    recent history. Messages no rule wants are neither scanned nor
+    tracked, which is what keeps ordinary chatter cheap.
+    """
+    def __init__(self, rules: list, tracker):
+        self.rules = rules
+        self.tracker = tracker
+        self.image_counts = {r.count for r in rules if isinstance(r, AttachmentsRule)}
+        # channel spread matches on signatures of any message, not just 4 image ones
+        spread_rules = [r for r in rules if isinstance(r, ChannelSpreadRule)]
+        self.spread = bool(spread_rules)
+        self.min_spread_text = min(r.min_length for r in spread_rules) if spread_rules else None
+        text_rules = [r for r in rules if isinstance(r, DuplicateTextRule)]
+        self.min_text = min(r.min_length for r in text_rules) if text_rules else None
+
+    @classmethod
+    def from_config(cls, rules_config: list, tracker):
+        rules = []
+        for options in rules_config or DEFAULT_RULES:
+            if not isinstance(options, dict):
+                raise ValueError(f'Spam rules must be objects, not {options!r}')
+            options = dict(options)
+            kind = options.pop('type', None)
+            if kind not in RULE_TYPES:
+                raise ValueError(f'Unknown spam rule type: {kind}')
+            for name, value in options.items():
+                # everything but the watched channels is a count, ratio or number of seconds
+                if name != 'watch' and value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+                    raise ValueError(f'{kind} {name} must be a number')
+            try:
+                rules.append(RULE_TYPES[kind](**options))
+            except TypeError as e:
+                raise ValueError(f'Bad options for spam rule {kind}: {e}')
+        return cls(rules, tracker)
+
+    def wants_images(self, count: int):
+        """Whether it's worth working out an image signature for a message with `count` images"""
+        return count > 0 and (self.spread or count in self.image_counts)
+
+    def features(self, message, images: list, image_signature: str=None):
+        f = Features()
+        f.user_id = message.author.id
+        f.channel_id = message.channel.id
+        f.message_id = message.id
+        f.timestamp = time.monotonic()
+        f.images = len(images)
+        f.text = normalize(message.content) if message.content else ''
+        f.signature = None
+        f.text_signature = False
+        f.minhash = None
+        f.links = 0
+        f.invites = 0
+
+        if image_signature is not None:
+            f.signature = signature_hash(image_signature)
+        elif f.text and self.spread and len(f.text) >= self.min_spread_text:
+            f.signature = signature_hash(f.text)
+            f.text_signature = True
+        if f.text:
+            if self.min_text is not None and len(f.text) >= self.min_text:
+                f.minhash = minhash(f.text)
+            if '://' in f.text or 'discord' in f.text:
+                f.links = len(LINK_RE.findall(f.text))
+                f.invites = len(INVITE_RE.findall(f.text))
+        return f
+
+    def check(self, f: Features):
+        """Track the message if any rule cares about it, and return a Match if one fires"""
+        rules = [r for r in self.rules if r.wants(f)]
+        if not rules:
+            return None
+
+        match = None
+        if f.user_id not in self.tracker.flagged:
+            states = [r.start(f) for r in rules]
+            for record in self.tracker.get(f.user_id):
+                for rule, state in zip(rules, states):
+                    rule.observe(state, record, f)
+            for rule, state in zip(rules, states):
+                if rule.matched(state, f):
+                    self.tracker.flagged.add(f.user_id)
+                    match = Match(rule, f)
+                    break
+
+        self.tracker.add(f.user_id, f.record())
+        return match
+
+    def collect(self, user_id: int, match: Match):
+        """The user's tracked records that belong to `match`"""
+        return [r for r in self.tracker.get(user_id) if match.rule.related(r, match.features)]
@@ -0,0 +1,64 @@
+import hashlib
+import time
+from collections import deque
+
+def signature_hash(signature: str) -> int:
+    """Fold a spam signature down to a fixed size 64 bit int"""
+    return int.from_bytes(hashlib.blake2b(signature.encode(), digest_size=8).digest(), 'big')
+
+class SpamRecord:
+    """Just enough of a message to match it against spam rules and delete it later"""
+    __slots__ = ('signature', 'timestamp', 'channel_id', 'message_id', 'minhash', 'links', 'invites')
+
+    def __init__(self, signature: int, timestamp: float, channel_id: int, message_id: int, minhash: tuple=None, links: int=0, invites: int=0):
+        self.signature = signature
+        self.timestamp = timestamp
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.minhash = minhash
+        self.links = links
+        self.invites = invites
+
+class SpamTracker:
+    """
+    Recently seen spam candidates per user, oldest first.
+
+    Every entry is also pushed onto one global arrival-ordered queue, so
+    `expire` only ever looks at entries that are actually due and an idle
+    sweep costs nothing.
+    """
+    def __init__(self):
+        self.users = {}
+        self.arrivals = deque()
+        self.flagged = set()
+
+    def add(self, user_id: int, record: SpamRecord):
+        entries = self.users.get(user_id)
+        if entries is None:
+            entries = self.users[user_id] = deque()
+        entries.append(record)
+        self.arrivals.append((record.timestamp, user_id))
+
+    def get(self, user_id: int):
+        return self.users.get(user_id, ())
+
+    def pop(self, user_id: int):
+        return self.users.pop(user_id, ())
+
+    def expire(self, window: float, now: float=None):
+        """Forget everything older than `window` seconds, except for users being flagged"""
+        if now is None:
+            now = time.monotonic()
+        cutoff = now - window
+        arrivals = self.arrivals
+        while arrivals and arrivals[0][0] <= cutoff:
+            _, user_id = arrivals.popleft()
+            if user_id in self.flagged:
+                continue
+            entries = self.users.get(user_id)
+            if not entries:
+                continue
+            while entries and entries[0].timestamp <= cutoff:
+                entries.popleft()
+            if not entries:
+                del self.users[user_id]
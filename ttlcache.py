@@ -0,0 +1,79 @@
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries also expire after `ttl` seconds.
+
+    Entries can be tagged with a group so related keys (every page of one
+    user's warnings, say) can be invalidated together. Readers that fill
+    the cache from a slower source should grab `generation` before they
+    start and pass it back to `set`; any invalidation in between bumps it
+    and the possibly stale value is dropped instead of cached.
+    """
+    def __init__(self, maxsize: int=256, ttl: float=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.groups = {}
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _remove(self, key):
+        _, _, group = self.data.pop(key)
+        if group is not None:
+            keys = self.groups[group]
+            keys.discard(key)
+            if not keys:
+                del self.groups[group]
+
+    def get(self, key, default=None):
+        try:
+            expires, value, _ = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires < time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, generation: int=None, group=None):
+        if generation is not None and generation != self.generation:
+            return
+        if key in self.data:
+            self._remove(key)
+        self.data[key] = (time.monotonic() + self.ttl, value, group)
+        if group is not None:
+            self.groups.setdefault(group, set()).add(key)
+        while len(self.data) > self.maxsize:
+            self._remove(next(iter(self.data)))
+            self.evictions += 1
+
+    def invalidate(self, group):
+        """Drop every entry tagged with `group`"""
+        self.generation += 1
+        for key in self.groups.pop(group, ()):
+            del self.data[key]
+
+    def clear(self):
+        self.generation += 1
+        self.data.clear()
+        self.groups.clear()
+
+    def stats(self):
+        return {
+            'size': len(self.data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }